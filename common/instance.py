@@ -13,6 +13,7 @@ class Instance:
         self.dep_label_ids = None
         self.dep_head_ids = None
         self.output_ids = None
+        self.lines = None
 
     def __len__(self):
         return len(self.input)
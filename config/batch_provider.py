@@ -0,0 +1,141 @@
+#
+# @author: Allan
+#
+
+import threading
+import queue
+import numpy as np
+from typing import List
+from common.instance import Instance
+from config.utils import simple_batching
+
+
+def bucket_batches(lengths: List[int], batch_size: int, max_tokens: int = 0, shuffle: bool = False, pool_size: int = 100) -> List[List[int]]:
+    """
+    Group sentences of similar length into batches, so that little padding is needed.
+    :param lengths: the length of every sentence
+    :param batch_size: maximum number of sentences per batch, when there is no token budget
+    :param max_tokens: if > 0, maximum number of (padded) tokens per batch, i.e. number of sentences x max length.
+            The batches are only closed on this budget: batches of short sentences hold more than `batch_size` sentences.
+    :param shuffle: shuffle the sentences before bucketing them in pools of `pool_size` x `batch_size` sentences,
+            and shuffle the order of the batches. Otherwise all the sentences are sorted by length.
+    :return: the list of batches (sentence indices)
+    """
+    lengths = np.asarray(lengths)
+    if shuffle:
+        indices = np.random.permutation(len(lengths))
+        pool = pool_size * batch_size
+        pools = [indices[start:start + pool] for start in range(0, len(indices), pool)]
+    else:
+        pools = [np.arange(len(lengths))]
+    batches = []
+    for pool in pools:
+        ## stable sort keeps the random order among sentences of the same length
+        pool = pool[np.argsort(-lengths[pool], kind="stable")]
+        batch = []
+        batch_max_len = 0
+        for idx in pool.tolist():
+            max_len = max(batch_max_len, lengths[idx])
+            if max_tokens > 0:
+                full = (len(batch) + 1) * max_len > max_tokens
+            else:
+                full = len(batch) == batch_size
+            if batch and full:
+                batches.append(batch)
+                batch = []
+                max_len = lengths[idx]
+            batch.append(idx)
+            batch_max_len = max_len
+        if batch:
+            batches.append(batch)
+    if shuffle:
+        batches = [batches[i] for i in np.random.permutation(len(batches))]
+    return batches
+
+
+class BatchProvider:
+    """
+    Build the batches of a dataset on the fly instead of keeping all of them (including the
+    adjacency matrices and the contextual vectors) in memory for the whole run.
+    With `num_prefetch > 0`, a background thread prepares the next batches into a bounded queue
+    while the model works on the current one.
+    With `config.bucket_batching`, the batches contain sentences of similar length (re-bucketed
+    every epoch when shuffling) and `config.max_tokens` bounds the batches by the number of tokens instead of `config.batch_size`.
+    Iterating gives `(batch_insts, batch)` where `batch` is the tuple of `simple_batching`.
+    With `world_size > 1`, only the batches of the shard `rank` are given. The processes must use the same
+    random state to shuffle in the same way. The last batches are repeated so that all the shards have the same size.
+    """
+
+    def __init__(self, config, insts: List[Instance], shuffle: bool = False, rank: int = 0, world_size: int = 1):
+        self.config = config
+        self.insts = insts
+        self.shuffle = shuffle
+        self.rank = rank
+        self.world_size = world_size
+        self.num_prefetch = config.num_prefetch
+        self.bucket_batching = config.bucket_batching
+        self.lengths = [len(inst.input.words) for inst in insts]
+        batch_size = config.batch_size
+        if self.bucket_batching:
+            self.batches = bucket_batches(self.lengths, batch_size, config.max_tokens)
+        else:
+            self.batches = [list(range(start, min(start + batch_size, len(insts)))) for start in range(0, len(insts), batch_size)]
+
+    def __len__(self):
+        return (len(self.batches) + self.world_size - 1) // self.world_size
+
+    def build(self, batch: List[int]):
+        one_batch_insts = [self.insts[i] for i in batch]
+        return one_batch_insts, simple_batching(self.config, one_batch_insts)
+
+    def __iter__(self):
+        if self.shuffle and self.bucket_batching:
+            self.batches = bucket_batches(self.lengths, self.config.batch_size, self.config.max_tokens, shuffle=True)
+            order = self.batches
+        elif self.shuffle:
+            order = [self.batches[batch_id] for batch_id in np.random.permutation(len(self.batches))]
+        else:
+            order = self.batches
+        if self.world_size > 1:
+            padding = len(self) * self.world_size - len(order)
+            order = (order + order[:padding])[self.rank::self.world_size]
+        if self.num_prefetch <= 0:
+            for batch in order:
+                yield self.build(batch)
+            return
+        buffer = queue.Queue(maxsize=self.num_prefetch)
+        stop = threading.Event()
+
+        def put(item) -> bool:
+            while not stop.is_set():
+                try:
+                    buffer.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def worker():
+            try:
+                for batch in order:
+                    if not put((None, self.build(batch))):
+                        return
+            except Exception as e:
+                put((e, None))
+                return
+            put((None, None))
+
+        thread = threading.Thread(target=worker, daemon=True)
+        thread.start()
+        try:
+            while True:
+                error, item = buffer.get()
+                if error is not None:
+                    raise error
+                if item is None:
+                    break
+                yield item
+        finally:
+            ## also reached when the consumer stops early
+            stop.set()
+            thread.join()
@@ -6,6 +6,7 @@ import numpy as np
 from tqdm import tqdm
 from typing import List
 from common.instance import Instance
+from config.pretrain_embedding import PretrainEmbedding, load_pretrain_embedding
 from config.utils import PAD, START, STOP, ROOT, ROOT_DEP_LABEL, SELF_DEP_LABEL
 import torch
 from enum import Enum
@@ -48,6 +49,9 @@ class Config:
         self.root_dep_label = ROOT_DEP_LABEL
         self.self_label = SELF_DEP_LABEL
 
+        ## plain copy of the arguments, saved with the model (see model/artifact.py)
+        self.args = dict(vars(args))
+
         print(colored("[Info] remember to chec the root dependency label if changing the data. current: {}".format(self.root_dep_label), "red"  ))
 
         # self.device = torch.device("cuda" if args.gpu else "cpu")
@@ -55,7 +59,11 @@ class Config:
         self.embedding_dim = args.embedding_dim
         self.context_emb = ContextEmb[args.context_emb]
         self.context_emb_size = 0
-        self.embedding, self.embedding_dim = self.read_pretrain_embedding()
+        self.context_emb_store = args.context_emb_store
+        self.context_emb_dtype = args.context_emb_dtype
+        self.embedding_cache = args.embedding_cache
+        ## the pretrained embedding is read in `build_emb_table`, once the vocabulary is known
+        self.embedding = None
         self.word_embedding = None
         self.seed = args.seed
         self.digit2zero = args.digit2zero
@@ -67,6 +75,11 @@ class Config:
         self.train_file = "data/" + self.dataset + "/train."+train_affix+".conllx"
         self.dev_file = "data/" + self.dataset + "/dev."+train_affix+".conllx"
         self.test_file = "data/" + self.dataset + "/test."+self.affix+".conllx"
+        self.mode = args.mode
+        self.model_file = args.model_file
+        self.export_file = args.export_file
+        self.corpus_cache = args.corpus_cache
+        self.corpus_cache_dir = "data/" + self.dataset + "/cache"
         self.label2idx = {}
         self.idx2labels = []
         self.char2idx = {}
@@ -79,12 +92,25 @@ class Config:
         self.momentum = args.momentum
         self.l2 = args.l2
         self.num_epochs = args.num_epochs
+        self.accumulation_steps = max(1, args.accumulation_steps)
+        self.mixed_precision = args.mixed_precision
         # self.lr_decay = 0.05
         self.use_dev = True
         self.train_num = args.train_num
         self.dev_num = args.dev_num
         self.test_num = args.test_num
         self.batch_size = args.batch_size
+        self.num_prefetch = args.num_prefetch
+        self.bucket_batching = args.bucket_batching
+        self.max_tokens = args.max_tokens
+        self.num_threads = args.num_threads
+        self.num_interop_threads = args.num_interop_threads
+        self.pin_cores = args.pin_cores
+        self.num_replicas = args.num_replicas
+        self.world_size = args.world_size
+        self.scaling_baseline_sents_per_sec = args.scaling_baseline_sents_per_sec
+        self.dist_addr = args.dist_addr
+        self.dist_port = args.dist_port
         self.clip = 5
         self.lr_decay = args.lr_decay
         self.device = torch.device(args.device)
@@ -97,6 +123,11 @@ class Config:
         self.char_emb_size = 30
         self.charlstm_hidden_dim = 50
         self.use_char_rnn = args.use_char_rnn
+        self.char_dedup = args.char_dedup
+        self.char_cache_size = args.char_cache_size
+        self.feature_table = args.feature_table
+        self.quantize = args.quantize
+        self.word_embedding_dtype = args.word_embedding_dtype
         # self.use_head = args.use_head
         self.dep_model = DepModelType[args.dep_model]
 
@@ -107,6 +138,7 @@ class Config:
         self.adj_directed = args.gcn_adj_directed
         self.adj_self_loop = args.gcn_adj_selfloop
         self.edge_gate = args.gcn_gate
+        self.gcn_graph = args.gcn_graph
 
         self.dep_emb_size = args.dep_emb_size
         self.deplabel2idx = {}
@@ -117,6 +149,19 @@ class Config:
 
 
         self.interaction_func = InteractionFunction[args.inter_func] ## 0:concat, 1: addition, 2:gcn
+        self.crf_scan = args.crf_scan
+        self.iobes_constraint = args.iobes_constraint
+
+        self.serve_host = args.serve_host
+        self.serve_port = args.serve_port
+        self.serve_socket = args.serve_socket
+        self.max_batch_size = args.max_batch_size
+        self.max_wait_ms = args.max_wait_ms
+        self.with_confidence = args.with_confidence
+        self.nbest = args.nbest
+        self.predict_file = args.predict_file
+        self.predict_output = args.predict_output
+        self.predict_window = args.predict_window
 
 
     # def print(self):
@@ -124,25 +169,36 @@ class Config:
     #     print("\tuse gpu: " + )
 
     '''
-      read all the  pretrain embeddings
+      read the pretrain embeddings, only keeping the words in `vocab` (or their lowercased form) if given
     '''
-    def read_pretrain_embedding(self):
+    def read_pretrain_embedding(self, vocab=None):
         print("reading the pretraing embedding: %s" % (self.embedding_file))
         if self.embedding_file is None:
             print("pretrain embedding in None, using random embedding")
             return None, self.embedding_dim
+        if self.embedding_cache:
+            embedding = load_pretrain_embedding(self.embedding_file)
+            return embedding, embedding.dim
+        keep = None
+        if vocab is not None:
+            keep = set(vocab)
+            keep.update([word.lower() for word in vocab])
         embedding_dim = -1
         embedding = dict()
         with open(self.embedding_file, 'r', encoding='utf-8') as file:
-            for line in tqdm(file.readlines()):
+            for line in tqdm(file):
                 line = line.strip()
                 if len(line) == 0:
                     continue
+                if embedding_dim >= 0 and keep is not None and line.split(None, 1)[0] not in keep:
+                    continue
                 tokens = line.split()
                 if len(tokens) == 2:
                     continue
                 if embedding_dim < 0:
                     embedding_dim = len(tokens) - 1
+                    if keep is not None and tokens[0] not in keep:
+                        continue
                 else:
                     # print(tokens)
                     # print(embedding_dim)
@@ -154,6 +210,8 @@ class Config:
                 embedd[:] = tokens[1:]
                 first_col = tokens[0]
                 embedding[first_col] = embedd
+        if keep is not None:
+            print("[Info] Kept %d pretrained vectors for a vocabulary of %d words" % (len(embedding), len(vocab)))
         return embedding, embedding_dim
 
 
@@ -200,10 +258,19 @@ class Config:
         obtain the word2idx and idx2word as well.
     '''
     def build_emb_table(self):
+        self.embedding, self.embedding_dim = self.read_pretrain_embedding(self.word2idx)
         print("Building the embedding table for vocabulary...")
         scale = np.sqrt(3.0 / self.embedding_dim)
         if self.embedding is not None:
             print("[Info] Use the pretrained word embedding to initialize: %d x %d" % (len(self.word2idx), self.embedding_dim))
+            if isinstance(self.embedding, PretrainEmbedding):
+                ## gather the rows of the vocabulary at once, random init for the rest
+                vectors, found = self.embedding.gather(self.word2idx)
+                self.word_embedding = vectors.astype(np.float64)
+                missing = np.flatnonzero(~found)
+                self.word_embedding[missing, :] = np.random.uniform(-scale, scale, [len(missing), self.embedding_dim])
+                self.embedding = None
+                return
             self.word_embedding = np.empty([len(self.word2idx), self.embedding_dim])
             for word in self.word2idx:
                 if word in self.embedding:
@@ -219,6 +286,34 @@ class Config:
             for word in self.word2idx:
                 self.word_embedding[self.word2idx[word], :] = np.random.uniform(-scale, scale, [1, self.embedding_dim])
 
+    def get_vocab(self):
+        """
+        :return: the index tables (words, characters, entity labels and dependency labels)
+        """
+        return {
+            "idx2word": self.idx2word,
+            "idx2char": self.idx2char,
+            "idx2labels": self.idx2labels,
+            "deplabels": self.deplabels,
+        }
+
+    def set_vocab(self, vocab):
+        """
+        Restore the index tables returned by `get_vocab`.
+        """
+        self.idx2word = vocab["idx2word"]
+        self.word2idx = {word: idx for idx, word in enumerate(self.idx2word)}
+        self.unk_id = self.word2idx[self.UNK]
+        self.idx2char = vocab["idx2char"]
+        self.char2idx = {c: idx for idx, c in enumerate(self.idx2char)}
+        self.num_char = len(self.idx2char)
+        self.idx2labels = vocab["idx2labels"]
+        self.label2idx = {label: idx for idx, label in enumerate(self.idx2labels)}
+        self.label_size = len(self.label2idx)
+        self.deplabels = vocab["deplabels"]
+        self.deplabel2idx = {label: idx for idx, label in enumerate(self.deplabels)}
+        self.root_dep_label_id = self.deplabel2idx[self.root_dep_label]
+
     def build_deplabel_idx(self, insts):
         if self.self_label not in self.deplabel2idx:
             self.deplabels.append(self.self_label)
@@ -0,0 +1,84 @@
+#
+# @author: Allan
+#
+
+import os
+import pickle
+import numpy as np
+from typing import Iterable
+
+"""
+On-disk store for the contextual (ELMo/BERT/flair) vectors of one data file:
+    header.pkl   : number of sentences, number of tokens, dim and dtype, and the size and mtime of the source file
+    offsets.npy  : (num_sents + 1) token offsets of every sentence
+    matrix.bin   : (num_tokens x dim) raw matrix of all the token vectors, one sentence after another
+Each data file (train/dev/test) is one shard. The matrix is memory-mapped and sentences are
+returned as zero-copy views, so the vectors are only paged in when a batch touches them.
+"""
+
+
+class ContextEmbStore:
+
+    def __init__(self, path: str):
+        with open(os.path.join(path, "header.pkl"), 'rb') as f:
+            self.header = pickle.load(f)
+        self.dim = self.header["dim"]
+        self.offsets = np.load(os.path.join(path, "offsets.npy"))
+        self.matrix = np.memmap(os.path.join(path, "matrix.bin"), dtype=np.dtype(self.header["dtype"]), mode='r',
+                                shape=(self.header["num_tokens"], self.dim))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx: int) -> np.ndarray:
+        return self.matrix[self.offsets[idx]:self.offsets[idx + 1]]
+
+
+def write_context_store(path: str, vecs: Iterable[np.ndarray], dtype: str = "float32", source: str = None):
+    """
+    Write the per-sentence vectors (in the order of the sentences) into a store at `path`.
+    :param source: the file the vectors are read from, its size and mtime are recorded in the header
+    """
+    os.makedirs(path, exist_ok=True)
+    offsets = [0]
+    dim = 0
+    with open(os.path.join(path, "matrix.bin"), 'wb') as f:
+        for vec in vecs:
+            vec = np.asarray(vec, dtype=dtype)
+            dim = vec.shape[1]
+            f.write(np.ascontiguousarray(vec).tobytes())
+            offsets.append(offsets[-1] + vec.shape[0])
+    np.save(os.path.join(path, "offsets.npy"), np.asarray(offsets, dtype=np.int64))
+    header = {"num_sents": len(offsets) - 1, "num_tokens": offsets[-1], "dim": dim, "dtype": np.dtype(dtype).name}
+    if source is not None:
+        stat = os.stat(source)
+        header["source_size"] = stat.st_size
+        header["source_mtime"] = stat.st_mtime
+    ## the header is written last, an incomplete store is never picked up
+    with open(os.path.join(path, "header.pkl"), 'wb') as f:
+        pickle.dump(header, f)
+
+
+def load_context_store(file: str, dtype: str = "float32") -> ContextEmbStore:
+    """
+    Open the store of the pickled vector file `file`, converting the pickle if the store does not exist,
+    was built from a different version of the file or with another dtype.
+    """
+    path = file + ".store"
+    header_file = os.path.join(path, "header.pkl")
+    if os.path.exists(header_file):
+        with open(header_file, 'rb') as f:
+            header = pickle.load(f)
+        stat = os.stat(file)
+        if header.get("source_size") != stat.st_size or header.get("source_mtime") != stat.st_mtime \
+                or header["dtype"] != np.dtype(dtype).name:
+            print("[Info] The store of {} is stale, rebuilding it.".format(file))
+            ## remove the header first, an interrupted rebuild is never picked up
+            os.remove(header_file)
+    if not os.path.exists(header_file):
+        print("[Info] Converting {} into a memory-mapped store ({})".format(file, dtype))
+        with open(file, 'rb') as f:
+            all_vecs = pickle.load(f)
+        write_context_store(path, all_vecs, dtype, source=file)
+        del all_vecs
+    return ContextEmbStore(path)
@@ -0,0 +1,126 @@
+#
+# @author: Allan
+#
+
+import os
+import hashlib
+import pickle
+import shutil
+import numpy as np
+from typing import List, Optional
+from common.sentence import Sentence
+from common.instance import Instance
+
+"""
+Compiled corpus cache: the output of `use_iobes`, `build_*_idx` and `map_insts_ids` for
+train/dev/test is stored as flat int32 arrays (plus offsets) and the vocabulary tables.
+Later runs memory-map the arrays instead of parsing the CoNLL-X text again.
+"""
+
+CACHE_VERSION = 1
+SPLITS = ["train", "dev", "test"]
+ARRAYS = ["sent_offsets", "word_ids", "char_offsets", "char_ids", "heads", "dep_label_ids", "label_ids", "pos_ids"]
+
+
+def corpus_cache_key(conf, files: List[str]) -> str:
+    """
+    Hash the content of the source files together with the preprocessing options,
+    so that any change in the data or the options leads to a different cache.
+    """
+    sha = hashlib.sha1()
+    for file in files:
+        with open(file, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha.update(chunk)
+    options = "v{}|digit2zero={}|iobes={}|affix={}|dev_num={}|test_num={}".format(CACHE_VERSION, conf.digit2zero, True,
+                                                                                 conf.affix, conf.dev_num, conf.test_num)
+    sha.update(options.encode('utf-8'))
+    return sha.hexdigest()
+
+
+def corpus_cache_path(conf) -> str:
+    key = corpus_cache_key(conf, [conf.train_file, conf.dev_file, conf.test_file])
+    return os.path.join(conf.corpus_cache_dir, key[:16])
+
+
+def save_corpus_cache(path: str, conf, datasets: List[List[Instance]]):
+    """
+    Write the (already id-mapped) train/dev/test instances and the vocabulary tables to `path`.
+    """
+    print("[Info] Writing the compiled corpus cache to: {}".format(path))
+    tmp_path = path + ".tmp"
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    pos2idx = {}
+    idx2pos = []
+    for split, insts in zip(SPLITS, datasets):
+        sent_offsets = [0]
+        char_offsets = [0]
+        word_ids, char_ids, heads, dep_label_ids, label_ids, pos_ids = [], [], [], [], [], []
+        for inst in insts:
+            sent_offsets.append(sent_offsets[-1] + len(inst.input.words))
+            word_ids.extend(inst.word_ids)
+            for chars in inst.char_ids:
+                char_ids.extend(chars)
+                char_offsets.append(char_offsets[-1] + len(chars))
+            heads.extend(inst.input.heads)
+            dep_label_ids.extend(inst.dep_label_ids)
+            label_ids.extend(inst.output_ids)
+            for pos in inst.input.pos_tags:
+                if pos not in pos2idx:
+                    pos2idx[pos] = len(idx2pos)
+                    idx2pos.append(pos)
+                pos_ids.append(pos2idx[pos])
+        arrays = [sent_offsets, word_ids, char_offsets, char_ids, heads, dep_label_ids, label_ids, pos_ids]
+        for name, values in zip(ARRAYS, arrays):
+            np.save(os.path.join(tmp_path, "{}.{}.npy".format(split, name)), np.asarray(values, dtype=np.int32))
+    vocab = conf.get_vocab()
+    vocab["idx2pos"] = idx2pos
+    with open(os.path.join(tmp_path, "vocab.pkl"), 'wb') as f:
+        pickle.dump(vocab, f)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+
+
+def load_corpus_cache(path: str, conf) -> Optional[List[List[Instance]]]:
+    """
+    Restore the vocabulary tables into `conf` and rebuild the train/dev/test instances.
+    The id fields of every instance are views into the memory-mapped arrays.
+    :return: [trains, devs, tests], or None if there is no cache at `path`
+    """
+    vocab_file = os.path.join(path, "vocab.pkl")
+    if not os.path.exists(vocab_file):
+        return None
+    print("[Info] Loading the compiled corpus cache from: {}".format(path))
+    with open(vocab_file, 'rb') as f:
+        vocab = pickle.load(f)
+    conf.set_vocab(vocab)
+
+    words = np.asarray(conf.idx2word, dtype=object)
+    labels = np.asarray(conf.idx2labels, dtype=object)
+    deplabels = np.asarray(conf.deplabels, dtype=object)
+    pos_tags = np.asarray(vocab["idx2pos"], dtype=object)
+    datasets = []
+    for split in SPLITS:
+        arrays = {name: np.load(os.path.join(path, "{}.{}.npy".format(split, name)), mmap_mode='r') for name in ARRAYS}
+        sent_offsets = arrays["sent_offsets"].tolist()
+        char_offsets = arrays["char_offsets"]
+        insts = []
+        for start, end in zip(sent_offsets[:-1], sent_offsets[1:]):
+            word_ids = arrays["word_ids"][start:end]
+            heads = arrays["heads"][start:end]
+            dep_label_ids = arrays["dep_label_ids"][start:end]
+            label_ids = arrays["label_ids"][start:end]
+            sent = Sentence(words[word_ids].tolist(), heads.tolist(), deplabels[dep_label_ids].tolist(), pos_tags[arrays["pos_ids"][start:end]].tolist())
+            inst = Instance(sent, labels[label_ids].tolist())
+            inst.word_ids = word_ids
+            inst.char_ids = [arrays["char_ids"][char_offsets[i]:char_offsets[i + 1]] for i in range(start, end)]
+            inst.dep_head_ids = np.where(heads == -1, np.arange(end - start), heads)
+            inst.dep_label_ids = dep_label_ids
+            inst.output_ids = label_ids
+            insts.append(inst)
+        print("[Info] {} set: {} sentences from cache".format(split, len(insts)))
+        datasets.append(insts)
+    return datasets
@@ -0,0 +1,111 @@
+#
+# @author: Allan
+#
+
+import os
+import sys
+import glob
+import torch
+from typing import List
+
+"""
+CPU execution profile: the intra-op/inter-op thread counts of PyTorch and the cores a process may run on.
+"""
+
+
+def parse_cores(spec: str) -> List[int]:
+    """
+    :param spec: list of cores like "0-3,8,10-11", empty for none
+    """
+    cores = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            start, end = part.split("-")
+            cores.extend(range(int(start), int(end) + 1))
+        else:
+            cores.append(int(part))
+    return cores
+
+
+def available_cores() -> List[int]:
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def numa_nodes() -> List[List[int]]:
+    """
+    :return: the cores of every NUMA node (from sysfs), a single node with all the cores if unknown
+    """
+    nodes = []
+    for cpulist in sorted(glob.glob("/sys/devices/system/node/node[0-9]*/cpulist"), key=lambda f: int(f.split("node")[-1].split("/")[0])):
+        with open(cpulist, 'r') as f:
+            cores = parse_cores(f.read())
+        if cores:
+            nodes.append(cores)
+    return nodes if nodes else [list(range(os.cpu_count() or 1))]
+
+
+def split_cores(cores: List[int], num_parts: int) -> List[List[int]]:
+    """
+    Split the cores into `num_parts` groups of consecutive cores. The cores are ordered by NUMA node
+    first, so a group only spans several nodes if the groups are larger than the nodes.
+    If there are fewer cores than parts, the cores are shared.
+    """
+    node_of = {core: idx for idx, node in enumerate(numa_nodes()) for core in node}
+    cores = sorted(cores, key=lambda core: (node_of.get(core, 0), core))
+    if len(cores) < num_parts:
+        return [[cores[i % len(cores)]] for i in range(num_parts)]
+    size, rest = divmod(len(cores), num_parts)
+    parts = []
+    start = 0
+    for i in range(num_parts):
+        end = start + size + (1 if i < rest else 0)
+        parts.append(cores[start:end])
+        start = end
+    return parts
+
+
+def apply_cpu_profile(num_threads: int = 0, num_interop_threads: int = 0, cores: List[int] = None):
+    """
+    :param num_threads: intra-op threads, 0 keeps the default (or the number of pinned cores)
+    :param num_interop_threads: inter-op threads, 0 keeps the default
+    :param cores: pin the process to these cores
+    """
+    if cores:
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, cores)
+        else:
+            print("[Warning] Core pinning is not supported on this platform")
+        if num_threads <= 0:
+            num_threads = len(cores)
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads > 0:
+        try:
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError:
+            ## only possible before the first inter-op parallel work
+            print("[Warning] The number of inter-op threads is already set: %d" % (torch.get_num_interop_threads()))
+
+
+def peak_rss_mb(reset: bool = False) -> float:
+    """
+    :param reset: reset the peak afterwards (Linux only), so that the next call reports the peak since this one
+    :return: the peak resident memory of the process in MB
+    """
+    try:
+        with open("/proc/self/status", 'r') as f:
+            peak = [int(line.split()[1]) for line in f if line.startswith("VmHWM:")][0] / 1024
+        if reset:
+            with open("/proc/self/clear_refs", 'w') as f:
+                f.write("5")
+        return peak
+    except (OSError, IndexError):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        ## bytes on macOS, KB on the others
+        return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
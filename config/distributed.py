@@ -0,0 +1,66 @@
+#
+# @author: Allan
+#
+
+import os
+import torch
+import torch.distributed as dist
+import torch.nn as nn
+from config.cpu import apply_cpu_profile, parse_cores, split_cores
+
+"""
+Helpers of the data-parallel training (`--world_size > 1`): every process trains on its own shard
+of the batches and the gradients are averaged with the gloo backend before each update.
+"""
+
+
+def init_distributed(config, rank: int):
+    os.environ["MASTER_ADDR"] = config.dist_addr
+    os.environ["MASTER_PORT"] = str(config.dist_port)
+    dist.init_process_group("gloo", rank=rank, world_size=config.world_size)
+    ## share the cores of the node between the processes
+    if config.pin_cores:
+        apply_cpu_profile(config.num_threads, 0, split_cores(parse_cores(config.pin_cores), config.world_size)[rank])
+    else:
+        torch.set_num_threads(config.num_threads if config.num_threads > 0 else max(1, (os.cpu_count() or 1) // config.world_size))
+
+
+def broadcast_parameters(model: nn.Module):
+    """
+    Start every process from the parameters of rank 0.
+    """
+    for param in model.state_dict().values():
+        dist.broadcast(param, 0)
+
+
+def all_reduce_gradients(model: nn.Module, world_size: int):
+    """
+    Average the gradients of all the processes, in a single flattened all-reduce.
+    The parameters without a gradient in this step contribute zeros, every process sends the same buffer.
+    """
+    params = [param for param in model.parameters() if param.requires_grad]
+    grads = [param.grad if param.grad is not None else torch.zeros_like(param) for param in params]
+    flat = torch.cat([grad.contiguous().view(-1) for grad in grads])
+    dist.all_reduce(flat)
+    flat /= world_size
+    offset = 0
+    for param in params:
+        numel = param.numel()
+        grad = flat[offset:offset + numel].view_as(param)
+        if param.grad is None:
+            param.grad = grad.clone()
+        else:
+            param.grad.copy_(grad)
+        offset += numel
+
+
+def all_reduce_sum(value: float) -> float:
+    tensor = torch.tensor([value], dtype=torch.float64)
+    dist.all_reduce(tensor)
+    return tensor.item()
+
+
+def all_reduce_max(value: float) -> float:
+    tensor = torch.tensor([value], dtype=torch.float64)
+    dist.all_reduce(tensor, op=dist.ReduceOp.MAX)
+    return tensor.item()
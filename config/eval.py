@@ -114,7 +114,6 @@ def evaluate_num(batch_insts, batch_pred_ids, batch_gold_ids, word_seq_lens, idx
         length = word_seq_lens[idx]
         output = batch_gold_ids[idx][:length].tolist()
         prediction = batch_pred_ids[idx][:length].tolist()
-        prediction = prediction[::-1]
         output = [idx2label[l] for l in output]
         prediction =[idx2label[l] for l in prediction]
         batch_insts[idx].prediction = prediction
@@ -0,0 +1,107 @@
+#
+# @author: Allan
+#
+
+import os
+import pickle
+import numpy as np
+from tqdm import tqdm
+from typing import Dict, Tuple
+
+
+class PretrainEmbedding:
+    """
+    Pretrained embedding backed by a memory-mapped float32 matrix and a word -> row index.
+    Only the rows asked for by `gather` are ever copied into memory.
+    """
+
+    def __init__(self, matrix: np.ndarray, words):
+        self.matrix = matrix
+        self.word2row = {word: row for row, word in enumerate(words)}
+        self.dim = matrix.shape[1]
+
+    def __len__(self):
+        return len(self.word2row)
+
+    def __contains__(self, word):
+        return word in self.word2row
+
+    def __getitem__(self, word):
+        return self.matrix[self.word2row[word]].reshape(1, self.dim)
+
+    def gather(self, word2idx: Dict[str, int]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Look up every vocabulary word (or its lowercased form as a fallback).
+        :param word2idx:
+        :return: the gathered vectors (vocab_size x dim) and a boolean mask of the words found.
+        """
+        rows = np.full(len(word2idx), -1, dtype=np.int64)
+        for word, idx in word2idx.items():
+            row = self.word2row.get(word)
+            if row is None:
+                row = self.word2row.get(word.lower(), -1)
+            rows[idx] = row
+        found = rows >= 0
+        vectors = np.zeros([len(word2idx), self.dim], dtype=np.float32)
+        ## sorted reads are friendlier to the page cache
+        order = np.argsort(rows[found])
+        vectors[np.flatnonzero(found)[order]] = self.matrix[rows[found][order]]
+        return vectors, found
+
+
+def _cache_files(embedding_file: str) -> Tuple[str, str]:
+    return embedding_file + ".f32", embedding_file + ".vocab.pkl"
+
+
+def convert_text_embedding(embedding_file: str):
+    """
+    Convert a GloVe/fastText text file into a raw float32 matrix and a vocabulary index.
+    The same lines as in `Config.read_pretrain_embedding` are skipped (header, malformed lines).
+    """
+    print("[Info] Converting the pretrained embedding into a binary cache: %s" % (embedding_file))
+    matrix_file, vocab_file = _cache_files(embedding_file)
+    embedding_dim = -1
+    words = []
+    with open(embedding_file, 'r', encoding='utf-8') as file, open(matrix_file + ".tmp", 'wb') as out:
+        for line in tqdm(file):
+            line = line.strip()
+            if len(line) == 0:
+                continue
+            tokens = line.split()
+            if len(tokens) == 2:
+                continue
+            if embedding_dim < 0:
+                embedding_dim = len(tokens) - 1
+            elif (embedding_dim + 1) != len(tokens):
+                continue
+            out.write(np.asarray(tokens[1:], dtype=np.float32).tobytes())
+            words.append(tokens[0])
+    stat = os.stat(embedding_file)
+    meta = {"source_size": stat.st_size, "source_mtime": stat.st_mtime, "dim": embedding_dim, "words": words}
+    with open(vocab_file + ".tmp", 'wb') as f:
+        pickle.dump(meta, f)
+    os.replace(matrix_file + ".tmp", matrix_file)
+    os.replace(vocab_file + ".tmp", vocab_file)
+
+
+def load_pretrain_embedding(embedding_file: str) -> PretrainEmbedding:
+    """
+    Memory-map the binary cache of `embedding_file`, converting the text file first
+    if the cache does not exist or is older than the text file.
+    """
+    matrix_file, vocab_file = _cache_files(embedding_file)
+    meta = None
+    if os.path.exists(matrix_file) and os.path.exists(vocab_file):
+        with open(vocab_file, 'rb') as f:
+            meta = pickle.load(f)
+        stat = os.stat(embedding_file)
+        if meta["source_size"] != stat.st_size or meta["source_mtime"] != stat.st_mtime:
+            print("[Info] The binary embedding cache is stale, rebuilding it.")
+            meta = None
+    if meta is None:
+        convert_text_embedding(embedding_file)
+        with open(vocab_file, 'rb') as f:
+            meta = pickle.load(f)
+    matrix = np.memmap(matrix_file, dtype=np.float32, mode='r', shape=(len(meta["words"]), meta["dim"]))
+    print("[Info] Memory-mapped pretrained embedding: %d x %d" % (matrix.shape[0], matrix.shape[1]))
+    return PretrainEmbedding(matrix, meta["words"])
@@ -5,9 +5,11 @@
 from tqdm import tqdm
 from common.sentence import Sentence
 from common.instance import Instance
-from typing import List
+from typing import List, Iterator
+import sys
 import re
 import pickle
+from config.context_store import load_context_store
 
 class Reader:
 
@@ -17,28 +19,49 @@ class Reader:
         self.vocab = set()
 
     def read_conll(self, file: str, number: int = -1, is_train: bool = True) -> List[Instance]:
+        return list(self.iter_conll(file, number, is_train))
+
+    def iter_conll(self, file: str, number: int = -1, is_train: bool = True, with_label: bool = True) -> Iterator[Instance]:
+        """
+        Stream the CoNLL-X file and yield one instance per sentence, so the whole file
+        (and the split lines) never sit in memory together.
+        The vocabulary and the entity count are collected as the sentences go past.
+        :param file: the file name, "-" for the standard input
+        :param number: stop after this number of sentences (-1 means read all)
+        :param is_train:
+        :param with_label: read the entity label of the last column. Otherwise the output of the
+                instances is None and the original lines are kept in `inst.lines`.
+        :return: generator of instances
+        """
         print("Reading file: " + file)
-        insts = []
+        num_insts = 0
         num_entity = 0
-        # vocab = set() ## build the vocabulary
         find_root = False
-        with open(file, 'r', encoding='utf-8') as f:
+        with (open(file, 'r', encoding='utf-8') if file != "-" else open(sys.stdin.fileno(), 'r', encoding='utf-8', closefd=False)) as f:
             words = []
             heads = []
             deps = []
             labels = []
             tags = []
-            for line in tqdm(f.readlines()):
+            lines = []
+            for line in tqdm(f):
                 line = line.rstrip()
                 if line == "":
-                    insts.append(Instance(Sentence(words, heads, deps, tags), labels))
+                    if len(words) == 0 and not with_label:
+                        continue
+                    num_insts += 1
+                    inst = Instance(Sentence(words, heads, deps, tags), labels if with_label else None)
+                    if not with_label:
+                        inst.lines = lines
+                    yield inst
                     words = []
                     heads = []
                     deps = []
                     labels = []
                     tags = []
+                    lines = []
                     find_root = False
-                    if len(insts) == number:
+                    if num_insts == number:
                         break
                     continue
                 # if "conll2003" in file:
@@ -49,7 +72,6 @@ class Reader:
                 head = int(vals[6])
                 dep_label = vals[7]
                 pos = vals[3]
-                label = vals[10]
                 if self.digit2zero:
                     word = re.sub('\d', '0', word) # replace digit with 0.
                 words.append(word)
@@ -59,11 +81,21 @@ class Reader:
                 deps.append(dep_label)
                 tags.append(pos)
                 self.vocab.add(word)
-                labels.append(label)
-                if label.startswith("B-"):
-                    num_entity +=1
-        print("number of sentences: {}, number of entities: {}".format(len(insts), num_entity))
-        return insts
+                if with_label:
+                    label = vals[10]
+                    labels.append(label)
+                    if label.startswith("B-"):
+                        num_entity +=1
+                else:
+                    lines.append(line)
+        if len(words) > 0:
+            ## no blank line after the last sentence
+            num_insts += 1
+            inst = Instance(Sentence(words, heads, deps, tags), labels if with_label else None)
+            if not with_label:
+                inst.lines = lines
+            yield inst
+        print("number of sentences: {}, number of entities: {}".format(num_insts, num_entity))
 
     def read_txt(self, file: str, number: int = -1, is_train: bool = True) -> List[Instance]:
         print("Reading file: " + file)
@@ -99,16 +131,27 @@ class Reader:
         print("number of sentences: {}".format(len(insts)))
         return insts
 
-    def load_elmo_vec(self, file, insts):
-        f = open(file, 'rb')
-        all_vecs = pickle.load(f)  # variables come out in the order you put them in
-        f.close()
+    def load_elmo_vec(self, file, insts, use_store: bool = False, dtype: str = "float32"):
+        """
+        Attach the contextual vectors to the instances.
+        :param file: the pickled list of per-sentence vectors
+        :param insts:
+        :param use_store: read from a memory-mapped store (converted from the pickle on the first use),
+                the vectors of each instance are then a zero-copy view into the store.
+        :param dtype: the dtype of the store if it has to be created
+        :return: the size of the vectors
+        """
+        if use_store:
+            all_vecs = load_context_store(file, dtype)
+        else:
+            f = open(file, 'rb')
+            all_vecs = pickle.load(f)  # variables come out in the order you put them in
+            f.close()
         size = 0
-        for vec, inst in zip(all_vecs, insts):
+        for idx, inst in zip(range(len(all_vecs)), insts):
+            vec = all_vecs[idx]
             inst.elmo_vec = vec
             size = vec.shape[1]
             # print(str(vec.shape[0]) + ","+ str(len(inst.input.words)) + ", " + str(inst.input.words))
             assert(vec.shape[0] == len(inst.input.words))
         return size
-
-
@@ -1,6 +1,7 @@
 import numpy as np
 import torch
 from typing import List
+from itertools import chain
 from common.instance import Instance
 from config.eval import Span
 
@@ -28,7 +29,8 @@ def log_sum_exp_pytorch(vec):
 def simple_batching(config, insts: List[Instance]):
     from config.config import DepModelType,ContextEmb
     """
-
+    Collate the batch with numpy indexing: the ids of all the tokens (and characters) are first
+    concatenated into flat arrays, then scattered into the padded tensors at once.
     :param config:
     :param insts:
     :return:
@@ -40,21 +42,49 @@ def simple_batching(config, insts: List[Instance]):
     """
     batch_size = len(insts)
     batch_data = sorted(insts, key=lambda inst: len(inst.input.words), reverse=True) ##object-based not direct copy
-    word_seq_len = torch.LongTensor(list(map(lambda inst: len(inst.input.words), batch_data)))
-    max_seq_len = word_seq_len.max()
+    lengths = np.asarray([len(inst.input.words) for inst in batch_data], dtype=np.int64)
+    num_tokens = int(lengths.sum())
+    max_seq_len = int(lengths.max())
+    ## (row, column) of every token in the padded batch
+    token_rows = np.repeat(np.arange(batch_size), lengths)
+    token_cols = np.arange(num_tokens) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+
+    def flat_ids(field: str) -> np.ndarray:
+        return np.fromiter(chain.from_iterable(getattr(inst, field) for inst in batch_data), dtype=np.int64, count=num_tokens)
+
+    def padded(flat: np.ndarray) -> torch.Tensor:
+        tensor = np.zeros((batch_size, max_seq_len), dtype=np.int64)
+        tensor[token_rows, token_cols] = flat
+        return torch.from_numpy(tensor)
+
     ### NOTE: the 1 here might be used later?? We will make this as padding, because later we have to do a deduction.
     #### Use 1 here because the CharBiLSTM accepts
-    char_seq_len = torch.LongTensor([list(map(len, inst.input.words)) + [1] * (int(max_seq_len) - len(inst.input.words)) for inst in batch_data])
-    max_char_seq_len = char_seq_len.max()
+    word_lens = np.fromiter((len(word) for inst in batch_data for word in inst.input.words), dtype=np.int64, count=num_tokens)
+    char_seq_len = np.ones((batch_size, max_seq_len), dtype=np.int64)
+    char_seq_len[token_rows, token_cols] = word_lens
+    max_char_seq_len = int(char_seq_len.max())
 
     word_emb_tensor = None
     if config.context_emb != ContextEmb.none:
         emb_size = insts[0].elmo_vec.shape[1]
-        word_emb_tensor = torch.zeros((batch_size, max_seq_len, emb_size))
+        ## filled in numpy, the vectors may be read-only (memory-mapped) or stored in float16
+        word_emb_tensor = np.zeros((batch_size, max_seq_len, emb_size), dtype=np.float32)
+        word_emb_tensor[token_rows, token_cols, :] = np.concatenate([inst.elmo_vec for inst in batch_data], axis=0)
+        word_emb_tensor = torch.from_numpy(word_emb_tensor)
+
+    word_seq_tensor = padded(flat_ids("word_ids"))
+    label_seq_tensor = padded(flat_ids("output_ids"))
+
+    ## characters: the token of every character, and its position inside the word
+    flat_chars = np.fromiter(chain.from_iterable(chain.from_iterable(inst.char_ids for inst in batch_data)), dtype=np.int64, count=int(word_lens.sum()))
+    char_token = np.repeat(np.arange(num_tokens), word_lens)
+    char_cols = np.arange(len(flat_chars)) - np.repeat(np.cumsum(word_lens) - word_lens, word_lens)
+    char_seq_tensor = np.zeros((batch_size, max_seq_len, max_char_seq_len), dtype=np.int64)
+    char_seq_tensor[token_rows[char_token], token_cols[char_token], char_cols] = flat_chars
+    pad_rows, pad_cols = np.nonzero(np.arange(max_seq_len)[None, :] >= lengths[:, None])
+    char_seq_tensor[pad_rows, pad_cols, 0] = config.char2idx[PAD]   ###because char_seq_len makes it 1, every single character should have a id. but actually 0 is enough
+    char_seq_tensor = torch.from_numpy(char_seq_tensor)
 
-    word_seq_tensor = torch.zeros((batch_size, max_seq_len), dtype=torch.long)
-    label_seq_tensor =  torch.zeros((batch_size, max_seq_len), dtype=torch.long)
-    char_seq_tensor = torch.zeros((batch_size, max_seq_len, max_char_seq_len), dtype=torch.long)
     adjs = None
     adjs_in = None
     adjs_out = None
@@ -64,7 +94,10 @@ def simple_batching(config, insts: List[Instance]):
     trees = None
     graphs = None
     if config.dep_model != DepModelType.none:
-        if  config.dep_model == DepModelType.dggcn:
+        if config.dep_model == DepModelType.dggcn and config.gcn_graph == "sparse":
+            graphs = head_to_edges(flat_ids("dep_label_ids"), np.fromiter(chain.from_iterable(inst.input.heads for inst in batch_data), dtype=np.int64, count=num_tokens),
+                                   token_rows, token_cols, config).to(config.device)
+        elif  config.dep_model == DepModelType.dggcn:
             adjs = [ head_to_adj(max_seq_len, inst, config) for inst in batch_data]
             adjs = np.stack(adjs, axis=0)
             adjs = torch.from_numpy(adjs)
@@ -72,22 +105,12 @@ def simple_batching(config, insts: List[Instance]):
             dep_label_adj = torch.from_numpy(np.stack(dep_label_adj, axis=0)).long()
 
         if config.dep_model == DepModelType.dglstm:
-            batch_dep_heads = torch.zeros((batch_size, max_seq_len), dtype=torch.long)
-            dep_label_tensor = torch.zeros((batch_size, max_seq_len), dtype=torch.long)
+            batch_dep_heads = padded(flat_ids("dep_head_ids"))
+            dep_label_tensor = padded(flat_ids("dep_label_ids"))
         # trees = [inst.tree for inst in batch_data]
-    for idx in range(batch_size):
-        word_seq_tensor[idx, :word_seq_len[idx]] = torch.LongTensor(batch_data[idx].word_ids)
-        label_seq_tensor[idx, :word_seq_len[idx]] = torch.LongTensor(batch_data[idx].output_ids)
-        if config.context_emb != ContextEmb.none:
-            word_emb_tensor[idx, :word_seq_len[idx], :] = torch.from_numpy(batch_data[idx].elmo_vec)
 
-        if config.dep_model == DepModelType.dglstm:
-            batch_dep_heads[idx, :word_seq_len[idx]] = torch.LongTensor(batch_data[idx].dep_head_ids)
-            dep_label_tensor[idx, :word_seq_len[idx]] = torch.LongTensor(batch_data[idx].dep_label_ids)
-        for word_idx in range(word_seq_len[idx]):
-            char_seq_tensor[idx, word_idx, :char_seq_len[idx, word_idx]] = torch.LongTensor(batch_data[idx].char_ids[word_idx])
-        for wordIdx in range(word_seq_len[idx], max_seq_len):
-            char_seq_tensor[idx, wordIdx, 0: 1] = torch.LongTensor([config.char2idx[PAD]])   ###because line 119 makes it 1, every single character should have a id. but actually 0 is enough
+    word_seq_len = torch.from_numpy(lengths)
+    char_seq_len = torch.from_numpy(char_seq_len)
 
     ### NOTE: make this step during forward if you have limited GPU resource.
     word_seq_tensor = word_seq_tensor.to(config.device)
@@ -143,7 +166,7 @@ def head_to_adj_label(max_len, inst, config):
     directed = config.adj_directed
     self_loop = config.adj_self_loop
 
-    dep_label_ret = np.zeros((max_len, max_len), dtype=np.long)
+    dep_label_ret = np.zeros((max_len, max_len), dtype=np.int64)
 
     for i, head in enumerate(inst.input.heads):
         if head == -1:
@@ -160,6 +183,70 @@ def head_to_adj_label(max_len, inst, config):
     return dep_label_ret
 
 
+def head_to_edges(dep_label_ids, heads, token_rows, token_cols, config):
+    """
+    Convert the heads of a batch into an edge list, the sparse counterpart of `head_to_adj` and `head_to_adj_label`.
+    :param dep_label_ids: (num_tokens) dependency label id of every token in the batch
+    :param heads: (num_tokens) head of every token, -1 for the root
+    :param token_rows: (num_tokens) sentence index of every token in the batch
+    :param token_cols: (num_tokens) position of every token in its sentence
+    :return: LongTensor (4, num_edges): sentence index, row (head), column (dependent) and dependency label id
+    """
+    arc = heads != -1
+    edges = np.stack([token_rows[arc], heads[arc], token_cols[arc], dep_label_ids[arc]], axis=0)
+    if not config.adj_directed:
+        edges = np.concatenate([edges, edges[[0, 2, 1, 3]]], axis=1)
+    return torch.from_numpy(edges)
+
+
+def allowed_transitions(idx2labels, start_idx, end_idx):
+    """
+    The legal transitions of the IOBES scheme:
+        START -> O, B-X, S-X;   O, E-X, S-X -> O, B-Y, S-Y, STOP;   B-X, I-X -> I-X, E-X
+    nothing goes into START, out of STOP, or into/out of PAD.
+    :param idx2labels:
+    :return: boolean numpy array (from_label, to_label)
+    """
+    num_labels = len(idx2labels)
+    allowed = np.zeros((num_labels, num_labels), dtype=bool)
+    for i, from_label in enumerate(idx2labels):
+        for j, to_label in enumerate(idx2labels):
+            if i == end_idx or j == start_idx or from_label == PAD or to_label == PAD:
+                continue
+            if i == start_idx:
+                from_prefix, from_type = "O", None
+            else:
+                from_prefix, from_type = from_label[0], from_label[2:]
+            if j == end_idx:
+                to_prefix, to_type = "O", None
+            else:
+                to_prefix, to_type = to_label[0], to_label[2:]
+            if from_prefix in ("B", "I"):
+                allowed[i, j] = to_prefix in ("I", "E") and to_type == from_type
+            else:
+                allowed[i, j] = to_prefix in ("O", "B", "S")
+    return allowed
+
+
+def reachable_labels(allowed, start_idx, end_idx):
+    """
+    The labels that can appear on a path from START to STOP under the `allowed` transitions.
+    """
+    from_start = np.zeros(len(allowed), dtype=bool)
+    frontier = allowed[start_idx].copy()
+    while not np.array_equal(frontier, from_start):
+        from_start = frontier
+        frontier = from_start | allowed[from_start].any(0)
+    to_end = np.zeros(len(allowed), dtype=bool)
+    frontier = allowed[:, end_idx].copy()
+    while not np.array_equal(frontier, to_end):
+        to_end = frontier
+        frontier = to_end | allowed[:, to_end].any(1)
+    keep = from_start & to_end
+    keep[[start_idx, end_idx]] = False
+    return np.flatnonzero(keep)
+
+
 def get_spans(output):
     output_spans = set()
     start = -1
@@ -173,6 +260,21 @@ def get_spans(output):
             output_spans.add(Span(i, i, output[i][2:]))
     return output_spans
 
+
+def get_span_confidences(output, marginals, label2idx):
+    """
+    The confidence of every predicted span, taken as the lowest posterior marginal of its labels.
+    :param output: the predicted labels of a sentence
+    :param marginals: (sent_len, label_size) posterior marginals of the sentence, see `NNCRF.marginals`
+    :param label2idx:
+    :return: list of (span, confidence)
+    """
+    token_probs = [float(marginals[i][label2idx[label]]) for i, label in enumerate(output)]
+    ## an ill-formed "E-" without a preceding "B-" gives a span starting at -1
+    spans = sorted([span for span in get_spans(output) if span.left >= 0], key=lambda span: span.left)
+    return [(span, min(token_probs[span.left:span.right + 1])) for span in spans]
+
+
 def preprocess(conf, insts, file_type:str):
     print("[Preprocess Info]Doing preprocessing for the CoNLL-2003 dataset: {}.".format(file_type))
     for inst in insts:
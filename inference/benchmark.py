@@ -0,0 +1,111 @@
+#
+# @author: Allan
+#
+
+import copy
+import time
+import numpy as np
+import torch
+from typing import List
+from common.instance import Instance
+from config import eval
+from config.batch_provider import BatchProvider, bucket_batches
+from config.cpu import peak_rss_mb
+from config.utils import simple_batching
+from model.lstmcrf import NNCRF
+from model.quantize import quantize_model, model_size
+
+
+def decode_latencies(model: NNCRF, batches, repeat: int):
+    """
+    :return: the latency of every batch decoding (seconds, `repeat` times each) and the predictions of the last pass
+    """
+    latencies = []
+    predictions = []
+    with torch.no_grad():
+        for _ in range(repeat):
+            predictions = []
+            for batch in batches:
+                start_time = time.time()
+                _, batch_max_ids = model.decode(batch)
+                latencies.append(time.time() - start_time)
+                predictions.append(batch_max_ids)
+    return np.array(latencies), predictions
+
+
+def benchmark_feature_table(config, model: NNCRF, insts: List[Instance], repeat: int = 3):
+    """
+    Decode `insts` with the live embedding lookup and char LSTM, then with the precomputed feature table
+    (`NNCRF.build_feature_table`), and report the latency of both.
+    """
+    model.eval()
+    batches = [simple_batching(config, [insts[idx] for idx in batch]) for batch in bucket_batches([len(inst.input.words) for inst in insts], config.batch_size, config.max_tokens)]
+    num_unk = sum(inst.word_ids.count(config.unk_id) for inst in insts)
+    num_tokens = sum(len(inst.input.words) for inst in insts)
+    print("[Benchmark] %d sentences, %d batches, %d tokens (%.2f%% unknown)" % (len(insts), len(batches), num_tokens, 100.0 * num_unk / num_tokens), flush=True)
+
+    model.feature_table = None
+    decode_latencies(model, batches[:2], 1)
+    live, live_predictions = decode_latencies(model, batches, repeat)
+
+    start_time = time.time()
+    table = model.build_feature_table(config)
+    build_time = time.time() - start_time
+    print("[Benchmark] feature table: %d x %d (%.2fMB), built in %.2fs" % (table.size(0), table.size(1), table.numel() * table.element_size() / 1024 / 1024, build_time), flush=True)
+    decode_latencies(model, batches[:2], 1)
+    cached, cached_predictions = decode_latencies(model, batches, repeat)
+
+    different = sum(int((a != b).sum()) for a, b in zip(live_predictions, cached_predictions))
+    for name, latencies in [("live", live), ("table", cached)]:
+        print("[Benchmark] %s: %.2fms/batch (p50 %.2fms, p95 %.2fms), %.2f sents/s" % (name, 1000 * latencies.mean(), 1000 * np.percentile(latencies, 50),
+                                                                                         1000 * np.percentile(latencies, 95), len(insts) * repeat / latencies.sum()), flush=True)
+    print("[Benchmark] speedup: %.2fx, different predictions: %d" % (live.sum() / cached.sum(), different), flush=True)
+    return live, cached
+
+
+def quantization_report(config, model: NNCRF, sets, repeat: int = 1):
+    """
+    Evaluate the model converted to every operating point of `quantize_model` and report the F1 drift
+    against the float32 model, the decoding speed, the model size and the peak RSS of the process while
+    converting and decoding (it includes the data and the original model, and is only reset on Linux).
+    :param sets: list of (name, insts)
+    """
+    operating_points = [("float32", "none", "float32"), ("int8", "int8", "float32"),
+                        ("fp16 emb", "none", "float16"), ("bf16 emb", "none", "bfloat16"),
+                        ("int8 + fp16 emb", "int8", "float16"), ("int8 + bf16 emb", "int8", "bfloat16")]
+    set_batches = [(name, [(batch_insts, batch) for batch_insts, batch in BatchProvider(config, insts)], len(insts)) for name, insts in sets]
+    model.eval()
+    model.feature_table = None
+    results = []
+    for name, quantize, embedding_dtype in operating_points:
+        peak_rss_mb(reset=True)
+        converted = quantize_model(copy.deepcopy(model), quantize, embedding_dtype)
+        fscores = []
+        elapsed = 0
+        num_sents = 0
+        with torch.no_grad():
+            for set_name, batches, size in set_batches:
+                metrics = np.asarray([0, 0, 0], dtype=int)
+                for _ in range(repeat):
+                    start_time = time.time()
+                    predictions = [converted.decode(batch)[1] for _, batch in batches]
+                    elapsed += time.time() - start_time
+                num_sents += size * repeat
+                for (batch_insts, batch), batch_max_ids in zip(batches, predictions):
+                    sorted_batch_insts = sorted(batch_insts, key=lambda inst: len(inst.input.words), reverse=True)
+                    metrics += eval.evaluate_num(sorted_batch_insts, batch_max_ids, batch[-2], batch[1], config.idx2labels)
+                p, total_predict, total_entity = metrics
+                precision = p * 1.0 / total_predict * 100 if total_predict != 0 else 0
+                recall = p * 1.0 / total_entity * 100 if total_entity != 0 else 0
+                fscores.append(2.0 * precision * recall / (precision + recall) if precision != 0 or recall != 0 else 0)
+        results.append((name, model_size(converted), fscores, num_sents / elapsed, peak_rss_mb()))
+        del converted
+        print("[Quantization] %s: %.2fMB, %s, %.2f sents/s, peak RSS %.1fMB" % (name, results[-1][1] / 1024 / 1024,
+              ", ".join("%s F1 %.2f" % (set_name, fscore) for (set_name, _, _), fscore in zip(set_batches, fscores)), results[-1][3], results[-1][4]), flush=True)
+
+    _, base_size, base_fscores, base_speed, _ = results[0]
+    print("[Quantization] %-16s %9s %9s %12s %s %9s" % ("", "size(MB)", "rel. size", "peak RSS(MB)", " ".join("%8s %7s" % (set_name + " F1", "drift") for set_name, _, _ in set_batches), "speedup"))
+    for name, size, fscores, speed, rss in results:
+        print("[Quantization] %-16s %9.2f %8.0f%% %12.1f %s %8.2fx" % (name, size / 1024 / 1024, 100.0 * size / base_size, rss,
+              " ".join("%8.2f %+7.2f" % (fscore, fscore - base_fscore) for fscore, base_fscore in zip(fscores, base_fscores)), speed / base_speed), flush=True)
+    return results
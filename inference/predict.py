@@ -0,0 +1,72 @@
+#
+# @author: Allan
+#
+
+import time
+from itertools import islice
+from typing import Iterator, List
+from common.instance import Instance
+from config.reader import Reader
+from config.batch_provider import bucket_batches
+from config.cpu import parse_cores
+from inference.server import Predictor
+from inference.replicas import ReplicaPool
+from model.lstmcrf import NNCRF
+
+
+def iter_windows(insts: Iterator[Instance], window: int) -> Iterator[List[Instance]]:
+    while True:
+        chunk = list(islice(insts, window))
+        if not chunk:
+            return
+        yield chunk
+
+
+def predict_file(config, model: NNCRF, input_file: str, output_file: str, window: int = 1000):
+    """
+    Tag an unlabeled CoNLL-X file (or the standard input with "-") window by window: the sentences of
+    a window are batched by length, decoded, and written in the input order before the next window is read,
+    so the memory does not grow with the size of the input.
+    With `config.num_replicas > 1`, the batches are decoded by a pool of pinned replicas.
+    Every line is written with all its fields (padded with "_" to the 10 CoNLL-X columns) followed by the predicted
+    entity label, i.e. the 11th column for a CoNLL-X file. With `config.with_confidence`, the next column is the posterior marginal of the predicted label, and with
+    `config.nbest = k` (k > 1), the next k - 1 columns are the labels of the 2nd to k-th best sequences ("_" if there are fewer).
+    """
+    predictor = Predictor(config, model)
+    pool = ReplicaPool(config, model, config.num_replicas, parse_cores(config.pin_cores)) if config.num_replicas > 1 else None
+    reader = Reader(config.digit2zero)
+    num_sents = 0
+    num_tokens = 0
+    start_time = time.time()
+    with open(output_file, 'w', encoding='utf-8') as out:
+        for insts in iter_windows(reader.iter_conll(input_file, -1, False, with_label=False), window):
+            for inst in insts:
+                predictor.map_instance(inst)
+            predictions = [None] * len(insts)
+            batches = bucket_batches([len(inst.input.words) for inst in insts], config.batch_size, config.max_tokens)
+            if pool is not None:
+                batch_predictions = pool.predict([[insts[idx] for idx in batch] for batch in batches])
+            else:
+                batch_predictions = [predictor.predict_outputs([insts[idx] for idx in batch]) for batch in batches]
+            for batch, batch_prediction in zip(batches, batch_predictions):
+                for idx, prediction in zip(batch, batch_prediction):
+                    predictions[idx] = prediction
+            for inst, prediction in zip(insts, predictions):
+                for i, (line, label) in enumerate(zip(inst.lines, prediction["labels"])):
+                    fields = line.split()
+                    fields += ["_"] * (10 - len(fields)) + [label]
+                    if config.with_confidence:
+                        fields.append("%.4f" % prediction["confidences"][i])
+                    if config.nbest > 1:
+                        others = prediction["nbest"][1:]
+                        fields += [others[rank]["labels"][i] if rank < len(others) else "_" for rank in range(config.nbest - 1)]
+                    out.write("\t".join(fields) + "\n")
+                out.write("\n")
+                num_tokens += len(prediction["labels"])
+            out.flush()
+            num_sents += len(insts)
+    if pool is not None:
+        pool.close()
+    elapsed = time.time() - start_time
+    print("[Info] Tagged %d sentences (%d tokens) in %.2fs: %.2f sents/s, %.2f tokens/s" % (
+        num_sents, num_tokens, elapsed, num_sents / elapsed if elapsed > 0 else 0, num_tokens / elapsed if elapsed > 0 else 0), flush=True)
@@ -0,0 +1,149 @@
+#
+# @author: Allan
+#
+
+import time
+import queue
+import multiprocessing
+import numpy as np
+import torch
+from typing import List, Dict
+from common.instance import Instance
+from config.batch_provider import bucket_batches
+from config.cpu import apply_cpu_profile, split_cores, available_cores
+from config import eval
+from inference.server import Predictor
+from model.lstmcrf import NNCRF
+
+
+def replica_worker(config, model: NNCRF, cores: List[int], tasks, results):
+    try:
+        ## the inter-op threads are inherited from the parent process
+        apply_cpu_profile(len(cores), 0, cores)
+        predictor = Predictor(config, model)
+    except Exception as e:
+        ## a setup error has no job id, the pool fails the whole prediction
+        results.put((None, None, "cores {}: {}".format(cores, repr(e))))
+        return
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        job_id, insts = task
+        try:
+            results.put((job_id, predictor.predict_outputs(insts), None))
+        except Exception as e:
+            results.put((job_id, None, repr(e)))
+
+
+class ReplicaPool:
+    """
+    `num_replicas` forked processes with a copy of the model, each pinned to its own group of cores
+    (see `split_cores`). The batches are taken from a shared queue, a replica gets a new batch as soon
+    as it is done with the previous one.
+    """
+
+    def __init__(self, config, model: NNCRF, num_replicas: int, cores: List[int] = None):
+        cores = cores if cores else available_cores()
+        self.core_groups = split_cores(cores, num_replicas)
+        context = multiprocessing.get_context("fork")
+        self.tasks = context.Queue()
+        self.results = context.Queue()
+        model.eval()
+        self.processes = [context.Process(target=replica_worker, args=(config, model, group, self.tasks, self.results), daemon=True)
+                          for group in self.core_groups]
+        for process in self.processes:
+            process.start()
+
+    def predict(self, batches: List[List[Instance]], poll_interval: float = 1.0) -> List[List[Dict]]:
+        """
+        :param poll_interval: seconds between the checks that all the replicas are still alive
+        :return: the outputs of every batch (see `Predictor.predict_outputs`), in the order of `batches`
+        """
+        for job_id, insts in enumerate(batches):
+            self.tasks.put((job_id, insts))
+        predictions = [None] * len(batches)
+        for _ in range(len(batches)):
+            while True:
+                try:
+                    job_id, prediction, error = self.results.get(timeout=poll_interval)
+                    break
+                except queue.Empty:
+                    dead = [process.pid for process in self.processes if not process.is_alive()]
+                    if dead:
+                        self.terminate()
+                        raise RuntimeError("replica processes {} exited unexpectedly".format(dead))
+            if error is not None:
+                self.terminate()
+                raise RuntimeError("a replica failed: " + error)
+            predictions[job_id] = prediction
+        return predictions
+
+    def close(self):
+        for process in self.processes:
+            if process.is_alive():
+                self.tasks.put(None)
+        for process in self.processes:
+            process.join()
+
+    def terminate(self):
+        """
+        Stop all the replicas without waiting for the queued batches.
+        """
+        ## the queued batches are dropped, exiting must not wait for them to be flushed
+        self.tasks.cancel_join_thread()
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+        for process in self.processes:
+            process.join()
+
+
+def evaluate_replicas(config, pool: ReplicaPool, insts: List[Instance], name: str):
+    batches = [[insts[idx] for idx in batch] for batch in bucket_batches([len(inst.input.words) for inst in insts], config.batch_size, config.max_tokens)]
+    ## same counts as the evaluation in a single process (`eval.evaluate_num`), whatever the number of replicas
+    metrics = np.asarray([0, 0, 0], dtype=int)
+    for batch, predictions in zip(batches, pool.predict(batches)):
+        pred_ids = [torch.tensor([config.label2idx[label] for label in output["labels"]]) for output in predictions]
+        gold_ids = [torch.tensor(inst.output_ids) for inst in batch]
+        word_seq_lens = torch.tensor([len(inst.input.words) for inst in batch])
+        metrics += eval.evaluate_num(batch, pred_ids, gold_ids, word_seq_lens, config.idx2labels)
+    p, total_predict, total_entity = metrics
+    precision = p * 1.0 / total_predict * 100 if total_predict != 0 else 0
+    recall = p * 1.0 / total_entity * 100 if total_entity != 0 else 0
+    fscore = 2.0 * precision * recall / (precision + recall) if precision != 0 or recall != 0 else 0
+    print("[%s set] Precision: %.2f, Recall: %.2f, F1: %.2f" % (name, precision, recall, fscore), flush=True)
+    return [precision, recall, fscore]
+
+
+def cpu_sweep(config, model: NNCRF, insts: List[Instance], cores: List[int] = None, repeat: int = 3):
+    """
+    Decode `insts` with every combination of number of replicas x threads per replica (powers of 2)
+    that fits on the cores, and report the throughput of each.
+    """
+    cores = cores if cores else available_cores()
+    batches = [[insts[idx] for idx in batch] for batch in bucket_batches([len(inst.input.words) for inst in insts], config.batch_size, config.max_tokens)]
+    num_tokens = sum(len(inst.input.words) for inst in insts)
+    profiles = []
+    num_replicas = 1
+    while num_replicas <= len(cores):
+        num_threads = 1
+        while num_replicas * num_threads <= len(cores):
+            profiles.append((num_replicas, num_threads))
+            num_threads *= 2
+        num_replicas *= 2
+    results = []
+    for num_replicas, num_threads in profiles:
+        pool = ReplicaPool(config, model, num_replicas, cores[:num_replicas * num_threads])
+        ## warm up the replicas
+        pool.predict(batches[:num_replicas])
+        start_time = time.time()
+        for _ in range(repeat):
+            pool.predict(batches)
+        elapsed = (time.time() - start_time) / repeat
+        pool.close()
+        results.append((num_replicas, num_threads, len(insts) / elapsed, num_tokens / elapsed))
+        print("[CPU sweep] replicas: %d, threads/replica: %d, %.2f sents/s, %.2f tokens/s" % results[-1], flush=True)
+    best = max(results, key=lambda result: result[2])
+    print("[CPU sweep] best: %d replicas x %d threads, %.2f sents/s" % (best[0], best[1], best[2]), flush=True)
+    return results
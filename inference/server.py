@@ -0,0 +1,386 @@
+#
+# @author: Allan
+#
+
+import os
+import re
+import json
+import time
+import socket
+import threading
+import queue
+import http.client
+import numpy as np
+import torch
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+from typing import List, Dict, Optional
+from common.sentence import Sentence
+from common.instance import Instance
+from config.config import ContextEmb
+from config.utils import simple_batching, get_span_confidences, START, STOP, PAD
+from model.lstmcrf import NNCRF
+
+"""
+Long-running inference: a trained NNCRF is loaded once, the sentences of concurrent requests are
+grouped into micro-batches by a single worker thread, and the predictions are served over HTTP
+(TCP on localhost or a Unix socket).
+
+Request (POST /predict), with the CoNLL-X convention for the heads (1-indexed, 0 is the root):
+    {"sentences": [{"words": [...], "heads": [...], "dep_labels": [...], "context_emb": [[...], ...]}]}
+`context_emb` (one vector per word) is only needed if the model uses contextual embeddings.
+Response:
+    {"labels": [[...]], "latency_ms": ...}
+With `--with_confidence 1`, the response also has, for every sentence, the posterior marginal of every predicted
+label ("confidences") and the predicted spans with their confidence ("spans"). With `--nbest k` (k > 1), it has
+the k best label sequences with their scores ("nbest").
+GET /stats gives the number of requests/sentences/batches, the throughput and the latency percentiles.
+"""
+
+
+class Predictor:
+    """
+    Convert raw sentences into instances with the vocabulary of the model and decode them.
+    """
+
+    def __init__(self, config, model: NNCRF):
+        self.config = config
+        self.model = model
+        self.model.eval()
+        self.pad_label_id = config.label2idx[config.PAD]
+        self.nbest = config.nbest
+        self.with_confidence = config.with_confidence
+        ## unknown dependency labels fall back to the "self" label, the first one of the table
+        self.unk_dep_label_id = config.deplabel2idx[config.self_label]
+
+    def to_instance(self, sent: Dict) -> Instance:
+        """
+        :raise ValueError: if the sentence is malformed (it is rejected before being batched with other sentences)
+        """
+        if not isinstance(sent, dict):
+            raise ValueError("a sentence should be an object with words, heads and dep_labels")
+        words = sent["words"]
+        if not isinstance(words, list) or len(words) == 0:
+            raise ValueError("words should be a non-empty list")
+        if any(not isinstance(word, str) or len(word) == 0 for word in words):
+            raise ValueError("every word should be a non-empty string")
+        if self.config.digit2zero:
+            words = [re.sub('\d', '0', word) for word in words]
+        if "heads" in sent:
+            if not isinstance(sent["heads"], list) or any(not isinstance(head, int) or isinstance(head, bool) or head < 0 or head > len(words) for head in sent["heads"]):
+                raise ValueError("heads should be integers between 0 (root) and the number of words")
+            heads = [head - 1 for head in sent["heads"]]
+        else:
+            heads = [-1] * len(words)
+        dep_labels = sent["dep_labels"] if "dep_labels" in sent else [self.config.root_dep_label] * len(words)
+        if len(heads) != len(words) or len(dep_labels) != len(words):
+            raise ValueError("words, heads and dep_labels should have the same length")
+        inst = self.map_instance(Instance(Sentence(words, heads, dep_labels, ["_"] * len(words)), None))
+        if self.config.context_emb != ContextEmb.none:
+            if "context_emb" not in sent:
+                raise ValueError("the model uses {} vectors, context_emb is required".format(self.config.context_emb.name))
+            inst.elmo_vec = np.asarray(sent["context_emb"], dtype=np.float32)
+            if inst.elmo_vec.shape != (len(words), self.config.context_emb_size):
+                raise ValueError("context_emb should be of shape ({}, {})".format(len(words), self.config.context_emb_size))
+        return inst
+
+    def map_instance(self, inst: Instance) -> Instance:
+        """
+        The counterpart of `Config.map_insts_ids` for unseen text: unknown words, characters and
+        dependency labels do not raise an error.
+        """
+        words = inst.input.words
+        unk_char_id = self.config.char2idx[self.config.UNK]
+        inst.word_ids = [self.config.word2idx.get(word, self.config.unk_id) for word in words]
+        inst.char_ids = [[self.config.char2idx.get(c, unk_char_id) for c in word] for word in words]
+        inst.dep_head_ids = [i if head == -1 else head for i, head in enumerate(inst.input.heads)]
+        inst.dep_label_ids = [self.config.deplabel2idx.get(label, self.unk_dep_label_id) for label in inst.input.dep_labels]
+        inst.output_ids = [self.pad_label_id] * len(words)
+        return inst
+
+    def predict(self, insts: List[Instance]) -> List[List[str]]:
+        """
+        Decode a batch of instances, the predictions are returned in the order of `insts`.
+        """
+        ## same (stable) order as the rows of the batch
+        order = sorted(range(len(insts)), key=lambda i: len(insts[i].input.words), reverse=True)
+        batch = simple_batching(self.config, insts)
+        with torch.no_grad():
+            _, batch_max_ids = self.model.decode(batch)
+        batch_max_ids = batch_max_ids.tolist()
+        predictions = [None] * len(insts)
+        for row, idx in enumerate(order):
+            length = len(insts[idx].input.words)
+            predictions[idx] = [self.config.idx2labels[label] for label in batch_max_ids[row][:length]]
+        return predictions
+
+    def predict_outputs(self, insts: List[Instance]) -> List[Dict]:
+        """
+        Decode a batch of instances with the outputs of the options, in the order of `insts`:
+            labels: the predicted labels
+            confidences, spans: with `with_confidence`, the posterior marginal of every predicted label and
+                the predicted spans with their confidence (the lowest marginal of their labels)
+            nbest: with `nbest > 1`, the k best label sequences with their scores, without the sequences
+                going through the special labels (which only get the low scores of the masked transitions)
+        """
+        if self.nbest <= 1 and not self.with_confidence:
+            return [{"labels": labels} for labels in self.predict(insts)]
+        order = sorted(range(len(insts)), key=lambda i: len(insts[i].input.words), reverse=True)
+        batch = simple_batching(self.config, insts)
+        with torch.no_grad():
+            if self.with_confidence:
+                _, batch_max_ids, marginals = self.model.decode_with_marginals(batch)
+                marginals = marginals.cpu().numpy()
+            else:
+                _, batch_max_ids = self.model.decode(batch)
+            if self.nbest > 1:
+                nbest_scores, nbest_ids = self.model.decode_nbest(batch, self.nbest)
+                nbest_scores = nbest_scores.tolist()
+                nbest_ids = nbest_ids.tolist()
+        batch_max_ids = batch_max_ids.tolist()
+        special_labels = {START, STOP, PAD}
+        outputs = [None] * len(insts)
+        for row, idx in enumerate(order):
+            length = len(insts[idx].input.words)
+            labels = [self.config.idx2labels[label] for label in batch_max_ids[row][:length]]
+            output = {"labels": labels}
+            if self.with_confidence:
+                output["confidences"] = [float(marginals[row][i][label]) for i, label in enumerate(batch_max_ids[row][:length])]
+                output["spans"] = [{"start": span.left, "end": span.right, "label": span.type, "confidence": confidence}
+                                   for span, confidence in get_span_confidences(labels, marginals[row], self.config.label2idx)]
+            if self.nbest > 1:
+                output["nbest"] = []
+                for score, ids in zip(nbest_scores[row], nbest_ids[row]):
+                    path = [self.config.idx2labels[label] for label in ids[:length]]
+                    if np.isfinite(score) and not special_labels.intersection(path):
+                        output["nbest"].append({"labels": path, "score": score})
+            outputs[idx] = output
+        return outputs
+
+
+class MicroBatcher:
+    """
+    Group the sentences submitted by concurrent requests into batches of at most `max_batch_size`
+    sentences. A batch is started as soon as it is full, or `max_wait_ms` after its first sentence arrived.
+    """
+
+    def __init__(self, predictor: Predictor, max_batch_size: int = 32, max_wait_ms: float = 5.0, num_latency: int = 10000):
+        self.predictor = predictor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.requests = queue.Queue()
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.num_requests = 0
+        self.num_sents = 0
+        self.num_batches = 0
+        self.busy_time = 0.0
+        self.latencies = deque(maxlen=num_latency)
+        self.stop_event = threading.Event()
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def submit(self, inst: Instance) -> Future:
+        future = Future()
+        self.requests.put((inst, future))
+        return future
+
+    def predict(self, sents: List[Dict]) -> List[Dict]:
+        """
+        Blocking prediction of the sentences of one request, the latency is recorded.
+        :return: the outputs of every sentence, see `Predictor.predict_outputs`
+        """
+        start = time.time()
+        if not isinstance(sents, list):
+            raise ValueError("sentences should be a list")
+        ## all the sentences are checked before any of them is batched
+        insts = [self.predictor.to_instance(sent) for sent in sents]
+        futures = [self.submit(inst) for inst in insts]
+        predictions = [future.result() for future in futures]
+        with self.lock:
+            self.num_requests += 1
+            self.latencies.append(time.time() - start)
+        return predictions
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                first = self.requests.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            items = [first]
+            deadline = time.time() + self.max_wait
+            while len(items) < self.max_batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    items.append(self.requests.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            start = time.time()
+            try:
+                predictions = self.predictor.predict_outputs([inst for inst, _ in items])
+                for (_, future), prediction in zip(items, predictions):
+                    future.set_result(prediction)
+            except Exception:
+                ## decode the sentences one by one, so that only the faulty ones fail
+                for inst, future in items:
+                    try:
+                        future.set_result(self.predictor.predict_outputs([inst])[0])
+                    except Exception as e:
+                        future.set_exception(e)
+            with self.lock:
+                self.num_batches += 1
+                self.num_sents += len(items)
+                self.busy_time += time.time() - start
+
+    def stats(self) -> Dict:
+        with self.lock:
+            latencies = np.asarray(self.latencies) * 1000
+            elapsed = time.time() - self.start_time
+            return {
+                "requests": self.num_requests,
+                "sentences": self.num_sents,
+                "batches": self.num_batches,
+                "avg_batch_size": self.num_sents / self.num_batches if self.num_batches > 0 else 0,
+                "sents_per_sec": self.num_sents / elapsed if elapsed > 0 else 0,
+                "busy_sents_per_sec": self.num_sents / self.busy_time if self.busy_time > 0 else 0,
+                "latency_ms_p50": float(np.percentile(latencies, 50)) if len(latencies) > 0 else 0,
+                "latency_ms_p95": float(np.percentile(latencies, 95)) if len(latencies) > 0 else 0,
+                "latency_ms_p99": float(np.percentile(latencies, 99)) if len(latencies) > 0 else 0,
+            }
+
+    def close(self):
+        self.stop_event.set()
+        self.worker.join()
+
+
+class PredictHandler(BaseHTTPRequestHandler):
+
+    def send_json(self, code: int, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self.send_json(200, self.server.batcher.stats())
+        else:
+            self.send_json(404, {"error": "unknown path: " + self.path})
+
+    def do_POST(self):
+        if self.path != "/predict":
+            self.send_json(404, {"error": "unknown path: " + self.path})
+            return
+        start = time.time()
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            outputs = self.server.batcher.predict(request["sentences"])
+        except (ValueError, KeyError, TypeError) as e:
+            self.send_json(400, {"error": str(e)})
+            return
+        except Exception as e:
+            self.send_json(500, {"error": repr(e)})
+            return
+        response = {key: [output[key] for output in outputs] for key in (outputs[0].keys() if outputs else ["labels"])}
+        response["latency_ms"] = (time.time() - start) * 1000
+        self.send_json(200, response)
+
+    def log_message(self, format, *args):
+        ## one line per request would dominate the output
+        pass
+
+
+class PredictHTTPServer(ThreadingHTTPServer):
+    ## concurrent clients would be refused with the default backlog of 5
+    request_queue_size = 128
+
+
+class UnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def get_request(self):
+        request, _ = super().get_request()
+        ## BaseHTTPRequestHandler expects a (host, port) address
+        return request, ("local", 0)
+
+
+def make_server(batcher: MicroBatcher, host: str = "127.0.0.1", port: int = 8000, socket_path: Optional[str] = None):
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = UnixHTTPServer(socket_path, PredictHandler)
+    else:
+        server = PredictHTTPServer((host, port), PredictHandler)
+    server.batcher = batcher
+    return server
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, socket_path: str, timeout: float = 60):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class Client:
+    """
+    Client of the inference server, over localhost or a Unix socket.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 8000, socket_path: Optional[str] = None):
+        self.host = host
+        self.port = port
+        self.socket_path = socket_path
+
+    def request(self, method: str, path: str, body=None) -> Dict:
+        if self.socket_path:
+            conn = UnixHTTPConnection(self.socket_path)
+        else:
+            conn = http.client.HTTPConnection(self.host, self.port, timeout=60)
+        try:
+            data = json.dumps(body).encode('utf-8') if body is not None else None
+            conn.request(method, path, body=data, headers={"Content-Type": "application/json"})
+            response = json.loads(conn.getresponse().read())
+        finally:
+            conn.close()
+        if "error" in response:
+            raise RuntimeError(response["error"])
+        return response
+
+    def predict(self, sentences: List[Dict]) -> List[List[str]]:
+        return self.request("POST", "/predict", {"sentences": sentences})["labels"]
+
+    def stats(self) -> Dict:
+        return self.request("GET", "/stats")
+
+
+def serve(config, model: NNCRF):
+    batcher = MicroBatcher(Predictor(config, model), config.max_batch_size, config.max_wait_ms)
+    server = make_server(batcher, config.serve_host, config.serve_port, config.serve_socket)
+    if config.serve_socket:
+        print("[Info] Serving on unix socket {}".format(config.serve_socket), flush=True)
+    else:
+        print("[Info] Serving on http://{}:{}".format(config.serve_host, config.serve_port), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
+        if config.serve_socket and os.path.exists(config.serve_socket):
+            os.remove(config.serve_socket)
+        print("[Info] Stats: {}".format(batcher.stats()))
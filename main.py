@@ -5,15 +5,26 @@ import numpy as np
 from config.reader import Reader
 from config import eval
 from config.config import Config, ContextEmb, DepModelType
+from config.corpus_cache import corpus_cache_path, load_corpus_cache, save_corpus_cache
 import time
 from model.lstmcrf import NNCRF
 import torch
 import torch.optim as optim
 import torch.nn as nn
-from config.utils import lr_decay, simple_batching, get_spans, preprocess
-from typing import List
-from common.instance import Instance
+import torch.distributed as dist
+import multiprocessing
+from config.utils import lr_decay, get_spans, preprocess
+from config.batch_provider import BatchProvider
+from config.cpu import apply_cpu_profile, parse_cores, peak_rss_mb
+from config.distributed import init_distributed, broadcast_parameters, all_reduce_gradients, all_reduce_sum, all_reduce_max
 from termcolor import colored
+from inference import server
+from inference.predict import predict_file
+from inference.replicas import ReplicaPool, evaluate_replicas, cpu_sweep
+from inference.benchmark import benchmark_feature_table, quantization_report
+from model.artifact import save_model_artifact, load_model_artifact, load_model_state
+from model.export import export_torchscript, is_torchscript, load_torchscript
+from model.quantize import quantize_model
 import os
 
 
@@ -27,7 +38,7 @@ def setSeed(opt, seed):
         torch.cuda.manual_seed_all(seed)
 
 
-def parse_arguments(parser):
+def parse_arguments(parser, argv=None):
     ###Training Hyperparameters
     parser.add_argument('--mode', type=str, default='train')
     parser.add_argument('--device', type=str, default="cpu")
@@ -38,6 +49,7 @@ def parse_arguments(parser):
     parser.add_argument('--embedding_file', type=str, default="data/glove.6B.100d.txt")
     # parser.add_argument('--embedding_file', type=str, default=None)
     parser.add_argument('--embedding_dim', type=int, default=100)
+    parser.add_argument('--embedding_cache', type=int, default=0, choices=[0, 1], help="convert the embedding file once into a memory-mapped binary cache")
     parser.add_argument('--optimizer', type=str, default="sgd")
     parser.add_argument('--learning_rate', type=float, default=0.01) ##only for sgd now
     parser.add_argument('--momentum', type=float, default=0.0)
@@ -45,11 +57,27 @@ def parse_arguments(parser):
     parser.add_argument('--lr_decay', type=float, default=0)
     parser.add_argument('--batch_size', type=int, default=10)
     parser.add_argument('--num_epochs', type=int, default=100)
+    parser.add_argument('--accumulation_steps', type=int, default=1, help="number of batches whose gradients are accumulated before each update")
+    parser.add_argument('--mixed_precision', type=str, default="none", choices=["none", "bf16"], help="train with bfloat16 autocast (the CRF stays in float32)")
     parser.add_argument('--train_num', type=int, default=-1)
     parser.add_argument('--dev_num', type=int, default=-1)
     parser.add_argument('--test_num', type=int, default=-1)
     parser.add_argument('--eval_freq', type=int, default=4000, help="evaluate frequency (iteration)")
     parser.add_argument('--eval_epoch', type=int, default=0, help="evaluate the dev set after this number of epoch")
+    parser.add_argument('--bucket_batching', type=int, default=0, choices=[0, 1], help="batch sentences of similar length together")
+    parser.add_argument('--max_tokens', type=int, default=0, help="with bucket batching, maximum number of padded tokens per batch instead of batch_size sentences (0: use batch_size)")
+    parser.add_argument('--num_prefetch', type=int, default=4, help="number of batches prepared ahead by a background thread, 0 builds them in the main thread")
+    parser.add_argument('--model_file', type=str, default="", help="model file for the test/serve modes (default: the name used in training)")
+    parser.add_argument('--export_file', type=str, default="", help="TorchScript file written by the export mode (default: <model file>.ts)")
+    parser.add_argument('--num_threads', type=int, default=0, help="intra-op threads of PyTorch (0: default, or the number of pinned cores)")
+    parser.add_argument('--num_interop_threads', type=int, default=0, help="inter-op threads of PyTorch (0: default)")
+    parser.add_argument('--pin_cores', type=str, default="", help="pin to these cores, e.g. 0-7,16-23 (shared out between the processes)")
+    parser.add_argument('--num_replicas', type=int, default=1, help="model replicas (processes) for the test/predict modes, each pinned to its share of the cores")
+    parser.add_argument('--world_size', type=int, default=1, help="number of data-parallel training processes (gloo backend)")
+    parser.add_argument('--scaling_baseline_sents_per_sec', type=float, default=0, help="sents/s of a --world_size 1 run, to report the scaling efficiency of data-parallel training (0: not reported)")
+    parser.add_argument('--dist_addr', type=str, default="127.0.0.1", help="address of the rank 0 process")
+    parser.add_argument('--dist_port', type=int, default=29500, help="port of the rank 0 process")
+    parser.add_argument('--corpus_cache', type=int, default=0, choices=[0, 1], help="cache the preprocessed corpus as memory-mapped arrays")
 
     ## model hyperparameter
     parser.add_argument('--hidden_dim', type=int, default=200, help="hidden size of the LSTM")
@@ -63,20 +91,44 @@ def parse_arguments(parser):
     parser.add_argument('--gcn_dropout', type=float, default=0.5, help="GCN dropout")
     parser.add_argument('--gcn_adj_directed', type=int, default=0, choices=[0, 1], help="GCN ajacent matrix directed")
     parser.add_argument('--gcn_adj_selfloop', type=int, default=0, choices=[0, 1], help="GCN selfloop in adjacent matrix, now always false as add it in the model")
+    parser.add_argument('--gcn_graph', type=str, default="dense", choices=["dense", "sparse"], help="dense adjacency matrices or edge lists for the GCN")
     parser.add_argument('--gcn_gate', type=int, default=0, choices=[0, 1], help="add edge_wise gating")
 
     ##NOTE: this dropout applies to many places
     parser.add_argument('--dropout', type=float, default=0.5, help="dropout for embedding")
     parser.add_argument('--use_char_rnn', type=int, default=1, choices=[0, 1], help="use character-level lstm, 0 or 1")
+    parser.add_argument('--char_dedup', type=int, default=0, choices=[0, 1], help="run the character-level lstm once per word type of the batch")
+    parser.add_argument('--char_cache_size', type=int, default=50000, help="with char_dedup, number of word types whose character features are cached in eval mode (0: no cache)")
+    parser.add_argument('--feature_table', type=int, default=0, choices=[0, 1], help="test/serve/predict with the word embeddings and char features of the vocabulary precomputed once")
+    parser.add_argument('--quantize', type=str, default="none", choices=["none", "int8"], help="test/serve/predict with the LSTMs and linear layers dynamically quantized (cpu)")
+    parser.add_argument('--word_embedding_dtype', type=str, default="float32", choices=["float32", "float16", "bfloat16"], help="test/serve/predict with the word embedding table stored in this dtype")
     # parser.add_argument('--use_head', type=int, default=0, choices=[0, 1], help="not use dependency")
     parser.add_argument('--dep_model', type=str, default="none", choices=["none", "dggcn", "dglstm"], help="dependency method")
     parser.add_argument('--inter_func', type=str, default="mlp", choices=["concatenation", "addition",  "mlp"], help="combination method, 0 concat, 1 additon, 2 gcn, 3 more parameter gcn")
     parser.add_argument('--context_emb', type=str, default="none", choices=["none", "bert", "elmo", "flair"], help="contextual word embedding")
+    parser.add_argument('--iobes_constraint', type=int, default=0, choices=[0, 1], help="forbid the illegal IOBES transitions in training and decoding")
+    parser.add_argument('--crf_scan', type=int, default=0, choices=[0, 1], help="compute the CRF partition function with a parallel scan (O(log T) depth, more memory)")
+    parser.add_argument('--context_emb_store', type=int, default=0, choices=[0, 1], help="read the contextual vectors from a memory-mapped store instead of the pickle")
+    parser.add_argument('--context_emb_dtype', type=str, default="float32", choices=["float32", "float16"], help="dtype of the contextual vector store")
 
+    ## serving (--mode serve)
+    parser.add_argument('--serve_host', type=str, default="127.0.0.1")
+    parser.add_argument('--serve_port', type=int, default=8000)
+    parser.add_argument('--serve_socket', type=str, default="", help="serve on this unix socket instead of host:port")
+    parser.add_argument('--max_batch_size', type=int, default=32, help="maximum number of sentences in a micro-batch")
+    parser.add_argument('--max_wait_ms', type=float, default=5, help="maximum time a sentence waits for its micro-batch to fill")
+    parser.add_argument('--with_confidence', type=int, default=0, choices=[0, 1], help="serve/predict: also output the posterior marginals of the predicted labels and the span confidences")
+    parser.add_argument('--nbest', type=int, default=1, help="serve/predict: also output the k best label sequences")
 
+    ## prediction (--mode predict)
+    parser.add_argument('--predict_file', type=str, default="-", help="unlabeled CoNLL-X file to tag, - for the standard input")
+    parser.add_argument('--predict_output', type=str, default="", help="output file (default: <predict_file>.pred, or predictions.conllx for the standard input)")
+    parser.add_argument('--predict_window', type=int, default=1000, help="number of sentences read and tagged at a time")
 
 
-    args = parser.parse_args()
+
+
+    args = parser.parse_args(argv)
     for k in args.__dict__:
         print(k + ": " + str(args.__dict__[k]))
     return args
@@ -94,103 +146,158 @@ def get_optimizer(config: Config, model: nn.Module):
         print("Illegal optimizer: {}".format(config.optimizer))
         exit(1)
 
-def batching_list_instances(config: Config, insts:List[Instance]):
-    train_num = len(insts)
-    batch_size = config.batch_size
-    total_batch = train_num // batch_size + 1 if train_num % batch_size != 0 else train_num // batch_size
-    batched_data = []
-    for batch_id in range(total_batch):
-        one_batch_insts = insts[batch_id * batch_size:(batch_id + 1) * batch_size]
-        batched_data.append(simple_batching(config, one_batch_insts))
-
-    return batched_data
+def get_model_names(config: Config, epoch: int):
+    """
+    :return: the file names of the model and of the test results
+    """
+    dep_model_name = config.dep_model.name
+    if config.dep_model == DepModelType.dggcn:
+        dep_model_name += '(' + str(config.num_gcn_layers) + "," + str(config.gcn_dropout) + "," + str(
+            config.gcn_mlp_layers) + ")"
+    name = "lstm_{}_{}_crf_{}_{}_{}_dep_{}_elmo_{}_{}_gate_{}_epoch_{}_lr_{}_comb_{}".format(config.num_lstm_layer, config.hidden_dim, config.dataset, config.affix, config.train_num, dep_model_name, config.context_emb.name, config.optimizer.lower(), config.edge_gate, epoch, config.learning_rate, config.interaction_func)
+    return "model_files/" + name + ".m", "results/" + name + ".results"
 
-def learn_from_insts(config:Config, epoch: int, train_insts, dev_insts, test_insts):
+def learn_from_insts(config:Config, epoch: int, train_insts, dev_insts, test_insts, rank: int = 0):
     # train_insts: List[Instance], dev_insts: List[Instance], test_insts: List[Instance], batch_size: int = 1
+    ## returns the best dev F1 and the corresponding test F1 with their epochs ([f1, epoch])
+    ## with data-parallel training (world_size > 1), this runs in every process and rank 0 evaluates and saves the model
+    distributed = config.world_size > 1
     model = NNCRF(config)
+    if distributed:
+        broadcast_parameters(model)
+        ## different dropout masks in every process
+        torch.manual_seed(config.seed + rank)
     optimizer = get_optimizer(config, model)
     train_num = len(train_insts)
+    train_tokens = sum(len(inst.input.words) for inst in train_insts)
     print("number of instances: %d" % (train_num))
     print(colored("[Shuffled] Shuffle the training instance ids", "red"))
     random.shuffle(train_insts)
 
 
 
-    batched_data = batching_list_instances(config, train_insts)
-    dev_batches = batching_list_instances(config, dev_insts)
-    test_batches = batching_list_instances(config, test_insts)
+    batched_data = BatchProvider(config, train_insts, shuffle=True, rank=rank, world_size=config.world_size)
+    dev_batches = BatchProvider(config, dev_insts)
+    test_batches = BatchProvider(config, test_insts)
 
     best_dev = [-1, 0]
     best_test = [-1, 0]
 
-    dep_model_name = config.dep_model.name
-    if config.dep_model == DepModelType.dggcn:
-        dep_model_name += '(' + str(config.num_gcn_layers) + "," + str(config.gcn_dropout) + "," + str(
-            config.gcn_mlp_layers) + ")"
-    model_name = "model_files/lstm_{}_{}_crf_{}_{}_{}_dep_{}_elmo_{}_{}_gate_{}_epoch_{}_lr_{}_comb_{}.m".format(config.num_lstm_layer, config.hidden_dim, config.dataset, config.affix, config.train_num, dep_model_name, config.context_emb.name, config.optimizer.lower(), config.edge_gate, epoch, config.learning_rate, config.interaction_func)
-    res_name = "results/lstm_{}_{}_crf_{}_{}_{}_dep_{}_elmo_{}_{}_gate_{}_epoch_{}_lr_{}_comb_{}.results".format(config.num_lstm_layer, config.hidden_dim, config.dataset, config.affix, config.train_num, dep_model_name, config.context_emb.name, config.optimizer.lower(), config.edge_gate, epoch, config.learning_rate, config.interaction_func)
+    model_name, res_name = get_model_names(config, epoch)
     print("[Info] The model will be saved to: %s, please ensure models folder exist" % (model_name))
     if not os.path.exists("model_files"):
         os.makedirs("model_files")
     if not os.path.exists("results"):
         os.makedirs("results")
 
+    ## with accumulation, the loss (a sum over the sentences) is summed over `accumulation_steps` batches before each update
+    use_autocast = config.mixed_precision == "bf16"
     for i in range(1, epoch + 1):
         epoch_loss = 0
+        comm_time = 0
+        peak_rss_mb(reset=True)
         start_time = time.time()
         model.zero_grad()
         if config.optimizer.lower() == "sgd":
             optimizer = lr_decay(config, optimizer, i)
-        for index in np.random.permutation(len(batched_data)):
-        # for index in range(len(batched_data)):
+        for step, (_, batch) in enumerate(batched_data, 1):
             model.train()
-            batch_word, batch_wordlen, batch_context_emb, batch_char, batch_charlen, adj_matrixs, adjs_in, adjs_out, graphs, dep_label_adj, batch_dep_heads, trees, batch_label, batch_dep_label = batched_data[index]
-            loss = model.neg_log_obj(batch_word, batch_wordlen, batch_context_emb,batch_char, batch_charlen, adj_matrixs, adjs_in, adjs_out, graphs, dep_label_adj, batch_dep_heads, batch_label, batch_dep_label, trees)
+            batch_word, batch_wordlen, batch_context_emb, batch_char, batch_charlen, adj_matrixs, adjs_in, adjs_out, graphs, dep_label_adj, batch_dep_heads, trees, batch_label, batch_dep_label = batch
+            with torch.autocast(config.device.type, dtype=torch.bfloat16, enabled=use_autocast):
+                loss = model.neg_log_obj(batch_word, batch_wordlen, batch_context_emb,batch_char, batch_charlen, adj_matrixs, adjs_in, adjs_out, graphs, dep_label_adj, batch_dep_heads, batch_label, batch_dep_label, trees)
             epoch_loss += loss.item()
             loss.backward()
+            if step % config.accumulation_steps != 0 and step != len(batched_data):
+                continue
+            if distributed:
+                comm_start = time.time()
+                all_reduce_gradients(model, config.world_size)
+                comm_time += time.time() - comm_start
             if config.dep_model == DepModelType.dggcn:
                 torch.nn.utils.clip_grad_norm_(model.parameters(), config.clip) ##clipping the gradient
             optimizer.step()
             model.zero_grad()
 
         end_time = time.time()
-        print("Epoch %d: %.5f, Time is %.2fs" % (i, epoch_loss, end_time - start_time), flush=True)
-
-        if i + 1 >= config.eval_epoch:
+        if distributed:
+            ## the communication time includes the wait for the slower processes
+            epoch_loss = all_reduce_sum(epoch_loss)
+            comm_share = all_reduce_sum(comm_time / (end_time - start_time)) / config.world_size
+            comm_time = all_reduce_max(comm_time)
+            rss = all_reduce_max(peak_rss_mb())
+            if rank == 0:
+                ## the throughput counts every training sentence once, not the batches repeated to even out the shards
+                sents_per_sec = train_num / (end_time - start_time)
+                print("Epoch %d: %.5f, Time is %.2fs, communication: %.2fs, communication share: %.2f%%, %.2f sents/s, %.2f tokens/s, peak RSS (per process): %.1fMB" % (
+                    i, epoch_loss, end_time - start_time, comm_time, comm_share * 100, sents_per_sec,
+                    train_tokens / (end_time - start_time), rss), flush=True)
+                if config.scaling_baseline_sents_per_sec > 0:
+                    print("Epoch %d: scaling efficiency: %.2f%% (%.2f sents/s against %d x %.2f sents/s)" % (
+                        i, 100 * sents_per_sec / (config.world_size * config.scaling_baseline_sents_per_sec), sents_per_sec,
+                        config.world_size, config.scaling_baseline_sents_per_sec), flush=True)
+        else:
+            print("Epoch %d: %.5f, Time is %.2fs, %.2f sents/s, %.2f tokens/s, peak RSS: %.1fMB" % (i, epoch_loss, end_time - start_time, train_num / (end_time - start_time),
+                  train_tokens / (end_time - start_time), peak_rss_mb()), flush=True)
+
+        if i + 1 >= config.eval_epoch and rank == 0:
             model.eval()
-            dev_metrics = evaluate(config, model, dev_batches, "dev", dev_insts)
-            test_metrics = evaluate(config, model, test_batches, "test", test_insts)
+            dev_metrics = evaluate(config, model, dev_batches, "dev")
+            test_metrics = evaluate(config, model, test_batches, "test")
             if dev_metrics[2] > best_dev[0]:
                 print("saving the best model...")
                 best_dev[0] = dev_metrics[2]
                 best_dev[1] = i
                 best_test[0] = test_metrics[2]
                 best_test[1] = i
-                torch.save(model.state_dict(), model_name)
+                save_model_artifact(model_name, config, model)
                 write_results(res_name, test_insts)
             model.zero_grad()
+        if distributed:
+            dist.barrier()
 
+    if rank != 0:
+        return None
     print("The best dev: %.2f" % (best_dev[0]))
     print("The corresponding test: %.2f" % (best_test[0]))
     print("Final testing.")
-    model.load_state_dict(torch.load(model_name))
+    model.load_state_dict(load_model_state(model_name))
     model.eval()
-    evaluate(config, model, test_batches, "test", test_insts)
+    if config.feature_table:
+        model.build_feature_table(config)
+    evaluate(config, model, test_batches, "test")
     write_results(res_name, test_insts)
+    return best_dev, best_test
+
+
+
+def distributed_worker(rank: int, config: Config, train_insts, dev_insts, test_insts):
+    init_distributed(config, rank)
+    learn_from_insts(config, config.num_epochs, train_insts, dev_insts, test_insts, rank)
+    dist.destroy_process_group()
+
+def learn_distributed(config: Config, train_insts, dev_insts, test_insts):
+    """
+    Data-parallel training with `config.world_size` processes on this node.
+    The processes are forked, so they share the data and start from the same random state.
+    """
+    print(colored("[Info] Data-parallel training with %d processes" % (config.world_size), "yellow"))
+    context = multiprocessing.get_context("fork")
+    processes = [context.Process(target=distributed_worker, args=(rank, config, train_insts, dev_insts, test_insts)) for rank in range(config.world_size)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    if any(process.exitcode != 0 for process in processes):
+        print("[Error] A training process failed")
+        exit(1)
 
-
-
-def evaluate(config:Config, model: NNCRF, batch_insts_ids, name:str, insts: List[Instance]):
+def evaluate(config:Config, model: NNCRF, batches: BatchProvider, name:str):
     ## evaluation
     metrics = np.asarray([0, 0, 0], dtype=int)
-    batch_id = 0
-    batch_size = config.batch_size
-    for batch in batch_insts_ids:
-        one_batch_insts = insts[batch_id * batch_size:(batch_id + 1) * batch_size]
+    for one_batch_insts, batch in batches:
         sorted_batch_insts = sorted(one_batch_insts, key=lambda inst: len(inst.input.words), reverse=True)
         batch_max_scores, batch_max_ids = model.decode(batch)
         metrics += eval.evaluate_num(sorted_batch_insts, batch_max_ids, batch[-2], batch[1], config.idx2labels)
-        batch_id += 1
     p, total_predict, total_entity = metrics[0], metrics[1], metrics[2]
     precision = p * 1.0 / total_predict * 100 if total_predict != 0 else 0
     recall = p * 1.0 / total_entity * 100 if total_entity != 0 else 0
@@ -199,35 +306,73 @@ def evaluate(config:Config, model: NNCRF, batch_insts_ids, name:str, insts: List
     return [precision, recall, fscore]
 
 
-def test_model(config: Config, test_insts):
-    dep_model_name = config.dep_model.name
-    if config.dep_model == DepModelType.dggcn:
-        dep_model_name += '(' + str(config.num_gcn_layers) + ","+str(config.gcn_dropout)+ ","+str(config.gcn_mlp_layers)+")"
-    model_name = "model_files/lstm_{}_{}_crf_{}_{}_{}_dep_{}_elmo_{}_{}_gate_{}_epoch_{}_lr_{}_comb_{}.m".format(config.num_lstm_layer, config.hidden_dim,
-                                                                                                                                      config.dataset, config.affix,
-                                                                                                                                      config.train_num,
-                                                                                                                                      dep_model_name,
-                                                                                                                                      config.context_emb.name,
-                                                                                                                                      config.optimizer.lower(),
-                                                                                                                                      config.edge_gate,
-                                                                                                                                      config.num_epochs,
-                                                                                                                                      config.learning_rate, config.interaction_func)
-    res_name = "results/lstm_{}_{}_crf_{}_{}_{}_dep_{}_elmo_{}_{}_gate_{}_epoch_{}_lr_{}_comb_{}.results".format(config.num_lstm_layer, config.hidden_dim,
-                                                                                                                                      config.dataset, config.affix,
-                                                                                                                                      config.train_num,
-                                                                                                                                      dep_model_name,
-                                                                                                                                      config.context_emb.name,
-                                                                                                                                      config.optimizer.lower(),
-                                                                                                                                      config.edge_gate,
-                                                                                                                                      config.num_epochs,
-                                                                                                                                      config.learning_rate, config.interaction_func)
-    model = NNCRF(config)
-    model.load_state_dict(torch.load(model_name))
-    model.eval()
-    test_batches = batching_list_instances(config, test_insts)
-    evaluate(config, model, test_batches, "test", test_insts)
+def test_model(config: Config, test_insts, model=None):
+    """
+    :param model: a model loaded with its vocabulary (`load_model_artifact`, `load_torchscript`), or None to load the
+            weights of the model file into a model built with the vocabulary of the data
+    """
+    model_name, res_name = get_model_names(config, config.num_epochs)
+    if config.model_file:
+        model_name = config.model_file
+    if model is not None:
+        if isinstance(model, NNCRF):
+            prepare_inference(config, model)
+    elif is_torchscript(model_name):
+        ## exported model, the vocabulary has been rebuilt from the data
+        _, model = load_torchscript(model_name, argparse.Namespace(**config.args))
+    else:
+        model = NNCRF(config)
+        model.load_state_dict(load_model_state(model_name))
+        prepare_inference(config, model)
+    if config.num_replicas > 1:
+        pool = ReplicaPool(config, model, config.num_replicas, parse_cores(config.pin_cores))
+        evaluate_replicas(config, pool, test_insts, "test")
+        pool.close()
+    else:
+        test_batches = BatchProvider(config, test_insts)
+        evaluate(config, model, test_batches, "test")
     write_results(res_name, test_insts)
 
+def prepare_inference(config: Config, model: NNCRF):
+    """
+    Reduced precision and precomputed features of a trained model, as set by the options.
+    """
+    model.eval()
+    if config.quantize != "none" or config.word_embedding_dtype != "float32":
+        quantize_model(model, config.quantize, config.word_embedding_dtype)
+    if config.feature_table:
+        model.build_feature_table(config)
+    return model
+
+def load_trained_model(config: Config):
+    ## a model file with only the weights, the vocabulary has been rebuilt from the data
+    model_name = config.model_file if config.model_file else get_model_names(config, config.num_epochs)[0]
+    print("[Info] Loading the model from: %s" % (model_name))
+    model = NNCRF(config)
+    model.load_state_dict(load_model_state(model_name, config.device))
+    return model
+
+def run_trained_model(config: Config, model: NNCRF):
+    """
+    The serve and predict modes.
+    """
+    if isinstance(model, NNCRF):
+        prepare_inference(config, model)
+    elif config.with_confidence or config.nbest > 1:
+        print("[Error] The exported model only has the Viterbi decoding, --with_confidence and --nbest need the model artifact.")
+        exit(1)
+    if config.mode == "serve":
+        server.serve(config, model)
+    else:
+        if config.context_emb != ContextEmb.none:
+            print("[Error] The predict mode does not compute the {} vectors, use the serve mode with context_emb.".format(config.context_emb.name))
+            exit(1)
+        output = config.predict_output
+        if not output:
+            output = config.predict_file + ".pred" if config.predict_file != "-" else "predictions.conllx"
+        predict_file(config, model, config.predict_file, output, config.predict_window)
+        print("[Info] The predictions are written to: %s" % (output))
+
 def write_results(filename:str, insts):
     f = open(filename, 'w', encoding='utf-8')
     for inst in insts:
@@ -248,36 +393,87 @@ def write_results(filename:str, insts):
 
 
 
-def main():
-    parser = argparse.ArgumentParser(description="Dependency-Guided LSTM CRF implementation")
-    opt = parse_arguments(parser)
-    conf = Config(opt)
+def context_emb_file(config: Config, file: str) -> str:
+    return file.replace(".sd", "").replace(".ud", "").replace(".sud", "").replace(".predsd", "").replace(".predud", "").replace(".stud", "").replace(".ssd", "") + "." + config.context_emb.name + ".vec"
+
+def read_test_insts(config: Config, reader: Reader, predictor: server.Predictor):
+    """
+    Read the test set and map it with the vocabulary of a trained model (no other data nor the pretrained embedding is read).
+    The entity labels unknown to the model are counted as O.
+    """
+    tests = reader.read_conll(config.test_file, config.test_num, False)
+    if config.context_emb != ContextEmb.none:
+        reader.load_elmo_vec(context_emb_file(config, config.test_file), tests, config.context_emb_store, config.context_emb_dtype)
+    config.use_iobes(tests)
+    num_unknown = 0
+    for inst in tests:
+        predictor.map_instance(inst)
+        inst.output_ids = [config.label2idx.get(label, config.label2idx[config.O]) for label in inst.output]
+        num_unknown += sum(1 for label in inst.output if label not in config.label2idx)
+    if num_unknown > 0:
+        print(colored("[Warning] %d gold labels of the test set are unknown to the model, counted as O" % (num_unknown), "red"))
+    return tests
+
+def prepare_data(config: Config, reader: Reader):
+    """
+    Read (or load from the corpus cache) the train/dev/test sets, build the index tables and the embedding table.
+    :return: trains, devs, tests
+    """
+    cache_path = corpus_cache_path(config) if config.corpus_cache else None
+    cached = load_corpus_cache(cache_path, config) if config.corpus_cache else None
+    if cached is not None:
+        trains, devs, tests = cached
+    else:
+        trains = reader.read_conll(config.train_file, -1, True)
+        devs = reader.read_conll(config.dev_file, config.dev_num, False)
+        tests = reader.read_conll(config.test_file, config.test_num, False)
 
-    reader = Reader(conf.digit2zero)
-    setSeed(opt, conf.seed)
+    if config.context_emb != ContextEmb.none:
+        print('Loading the {} vectors for all datasets.'.format(config.context_emb.name))
+        config.context_emb_size = reader.load_elmo_vec(context_emb_file(config, config.train_file), trains, config.context_emb_store, config.context_emb_dtype)
+        reader.load_elmo_vec(context_emb_file(config, config.dev_file), devs, config.context_emb_store, config.context_emb_dtype)
+        reader.load_elmo_vec(context_emb_file(config, config.test_file), tests, config.context_emb_store, config.context_emb_dtype)
 
-    trains = reader.read_conll(conf.train_file, -1, True)
-    devs = reader.read_conll(conf.dev_file, conf.dev_num, False)
-    tests = reader.read_conll(conf.test_file, conf.test_num, False)
+    if cached is None:
+        config.use_iobes(trains + devs + tests)
+        config.build_label_idx(trains)
 
-    if conf.context_emb != ContextEmb.none:
-        print('Loading the {} vectors for all datasets.'.format(conf.context_emb.name))
-        conf.context_emb_size = reader.load_elmo_vec(conf.train_file.replace(".sd", "").replace(".ud", "").replace(".sud", "").replace(".predsd", "").replace(".predud", "").replace(".stud", "").replace(".ssd", "") + "."+conf.context_emb.name+".vec", trains)
-        reader.load_elmo_vec(conf.dev_file.replace(".sd", "").replace(".ud", "").replace(".sud", "").replace(".predsd", "").replace(".predud", "").replace(".stud", "").replace(".ssd", "")  + "."+conf.context_emb.name+".vec", devs)
-        reader.load_elmo_vec(conf.test_file.replace(".sd", "").replace(".ud", "").replace(".sud", "").replace(".predsd", "").replace(".predud", "").replace(".stud", "").replace(".ssd", "")  + "."+conf.context_emb.name+".vec", tests)
+        config.build_deplabel_idx(trains + devs + tests)
+        config.build_word_idx(trains, devs, tests)
+        config.map_insts_ids(trains + devs + tests)
+        if config.corpus_cache:
+            save_corpus_cache(cache_path, config, [trains, devs, tests])
+    print("# deplabels: ", len(config.deplabels))
+    print("dep label 2idx: ", config.deplabel2idx)
 
-    conf.use_iobes(trains + devs + tests)
-    conf.build_label_idx(trains)
+    config.build_emb_table()
+    return trains, devs, tests
 
-    conf.build_deplabel_idx(trains + devs + tests)
-    print("# deplabels: ", len(conf.deplabels))
-    print("dep label 2idx: ", conf.deplabel2idx)
 
+def main():
+    parser = argparse.ArgumentParser(description="Dependency-Guided LSTM CRF implementation")
+    opt = parse_arguments(parser)
+    conf = Config(opt)
+    apply_cpu_profile(conf.num_threads, conf.num_interop_threads, parse_cores(conf.pin_cores))
 
-    conf.build_word_idx(trains, devs, tests)
-    conf.build_emb_table()
-    conf.map_insts_ids(trains + devs + tests)
+    reader = Reader(conf.digit2zero)
+    setSeed(opt, conf.seed)
 
+    if opt.mode in ["serve", "predict", "test"]:
+        ## a self-contained model file needs neither the data nor the pretrained embedding
+        model_name = conf.model_file if conf.model_file else get_model_names(conf, conf.num_epochs)[0]
+        start_time = time.time()
+        loaded = load_torchscript(model_name, opt) if is_torchscript(model_name) else load_model_artifact(model_name, opt)
+        if loaded is not None:
+            print("[Info] Loaded the model from: %s in %.2fs" % (model_name, time.time() - start_time))
+            if opt.mode == "test":
+                config, model = loaded
+                test_model(config, read_test_insts(config, reader, server.Predictor(config, model)), model)
+            else:
+                run_trained_model(*loaded)
+            return
+
+    trains, devs, tests = prepare_data(conf, reader)
 
     print("num chars: " + str(conf.num_char))
     # print(str(config.char2idx))
@@ -288,7 +484,31 @@ def main():
         if conf.train_num != -1:
             random.shuffle(trains)
             trains = trains[:conf.train_num]
-        learn_from_insts(conf, conf.num_epochs, trains, devs, tests)
+        if conf.world_size > 1:
+            learn_distributed(conf, trains, devs, tests)
+        else:
+            learn_from_insts(conf, conf.num_epochs, trains, devs, tests)
+    elif opt.mode in ["serve", "predict"]:
+        run_trained_model(conf, load_trained_model(conf))
+    elif opt.mode == "cpu_sweep":
+        model_name = conf.model_file if conf.model_file else get_model_names(conf, conf.num_epochs)[0]
+        if os.path.exists(model_name):
+            model = load_trained_model(conf)
+        else:
+            ## the throughput does not depend on the weights
+            print("[Info] No model file, the sweep uses an untrained model.")
+            model = NNCRF(conf)
+        cpu_sweep(conf, model, tests, parse_cores(conf.pin_cores))
+    elif opt.mode == "feature_table_bench":
+        benchmark_feature_table(conf, load_trained_model(conf), tests)
+    elif opt.mode == "quant_report":
+        quantization_report(conf, load_trained_model(conf), [("dev", devs), ("test", tests)])
+    elif opt.mode == "export":
+        model_name = conf.model_file if conf.model_file else get_model_names(conf, conf.num_epochs)[0]
+        export_file = conf.export_file if conf.export_file else model_name + ".ts"
+        model = load_trained_model(conf)
+        ## the exported model is checked on the test set
+        export_torchscript(conf, model, export_file, [batch for _, batch in BatchProvider(conf, tests)])
     else:
         ## Load the trained model.
         test_model(conf, tests)
@@ -0,0 +1,79 @@
+#
+# @author: Allan
+#
+
+import argparse
+import numpy as np
+import torch
+from typing import Dict, Optional, Tuple
+from config.config import Config
+from model.lstmcrf import NNCRF
+
+"""
+Self-contained model file: the weights together with the index tables and the arguments of the
+training run, so that the model can be rebuilt without the data files and the pretrained embedding.
+Only plain python types and tensors are stored.
+"""
+
+ARTIFACT_VERSION = 1
+
+## options of the current run that override the ones saved with the model
+RUNTIME_ARGS = ["mode", "device", "batch_size", "num_prefetch", "bucket_batching", "max_tokens",
+                "context_emb_store", "context_emb_dtype",
+                "serve_host", "serve_port", "serve_socket", "max_batch_size", "max_wait_ms", "with_confidence", "nbest",
+                "predict_file", "predict_output", "predict_window",
+                "num_threads", "num_interop_threads", "pin_cores", "num_replicas", "char_dedup", "char_cache_size", "feature_table",
+                "quantize", "word_embedding_dtype", "test_num", "model_file"]
+
+
+def save_model_artifact(path: str, config: Config, model: NNCRF):
+    artifact = {
+        "version": ARTIFACT_VERSION,
+        "args": config.args,
+        "vocab": config.get_vocab(),
+        "embedding_dim": config.embedding_dim,
+        "context_emb_size": config.context_emb_size,
+        "state_dict": model.state_dict(),
+    }
+    torch.save(artifact, path)
+
+
+def is_model_artifact(obj) -> bool:
+    return isinstance(obj, dict) and "version" in obj and "state_dict" in obj
+
+
+def load_model_state(path: str, device=None) -> Dict:
+    """
+    :return: the state dict of a model artifact, or of a file saved with `torch.save(model.state_dict())`
+    """
+    obj = torch.load(path, map_location=device)
+    return obj["state_dict"] if is_model_artifact(obj) else obj
+
+
+def load_model_artifact(path: str, args: Optional[argparse.Namespace] = None) -> Optional[Tuple[Config, NNCRF]]:
+    """
+    Rebuild the config and the model saved by `save_model_artifact`.
+    :param path:
+    :param args: arguments of the current run, for the options in `RUNTIME_ARGS`
+            and the ones unknown to the saved model
+    :return: (config, model), or None if `path` only contains a state dict
+    """
+    device = args.device if args is not None else "cpu"
+    artifact = torch.load(path, map_location=device)
+    if not is_model_artifact(artifact):
+        return None
+    saved_args = dict(artifact["args"])
+    if args is not None:
+        for key, value in vars(args).items():
+            if key in RUNTIME_ARGS or key not in saved_args:
+                saved_args[key] = value
+    config = Config(argparse.Namespace(**saved_args))
+    config.set_vocab(artifact["vocab"])
+    config.embedding_dim = artifact["embedding_dim"]
+    config.context_emb_size = artifact["context_emb_size"]
+    ## overwritten by the state dict
+    config.word_embedding = np.zeros([len(config.word2idx), config.embedding_dim], dtype=np.float32)
+    model = NNCRF(config)
+    model.load_state_dict(artifact["state_dict"])
+    model.eval()
+    return config, model
@@ -4,6 +4,7 @@
 import torch
 import torch.nn as nn
 import numpy as np
+from collections import OrderedDict
 from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 
 
@@ -25,6 +26,11 @@ class CharBiLSTM(nn.Module):
 
         self.char_lstm = nn.LSTM(self.char_emb_size, self.hidden ,num_layers=1, batch_first=True, bidirectional=False).to(self.device)
 
+        ## encode every word type of the batch once, and cache the features of the types in eval mode
+        self.dedup = config.char_dedup
+        self.cache_size = config.char_cache_size
+        self.cache = OrderedDict()
+
 
     # def random_embedding(self, vocab_size, embedding_dim):
     #     pretrain_emb = np.empty([vocab_size, embedding_dim])
@@ -45,6 +51,26 @@ class CharBiLSTM(nn.Module):
         sent_len = char_seq_tensor.size(1)
         char_seq_tensor = char_seq_tensor.view(batch_size * sent_len, -1)
         char_seq_len = char_seq_len.view(batch_size * sent_len)
+        if not self.dedup:
+            return self.encode(char_seq_tensor, char_seq_len).view(batch_size, sent_len, -1)
+        ## the characters after the length of a word are 0, so the rows of the same word are equal
+        types, inverse = torch.unique(char_seq_tensor, dim=0, return_inverse=True)
+        type_lens = char_seq_len.new_zeros(types.size(0)).scatter_(0, inverse, char_seq_len)
+        if not self.training and self.cache_size > 0:
+            type_features = self.encode_cached(types, type_lens)
+        else:
+            type_features = self.encode(types, type_lens)
+        return type_features[inverse].view(batch_size, sent_len, -1)
+
+    def encode(self, char_seq_tensor, char_seq_len):
+        """
+            input:
+                char_seq_tensor: (num_words, word_length)
+                char_seq_len: (num_words)
+            output:
+                Variable(num_words, char_hidden_dim)
+        """
+        num_words = char_seq_tensor.size(0)
         sorted_seq_len, permIdx = char_seq_len.sort(0, descending=True)
         _, recover_idx = permIdx.sort(0, descending=False)
         sorted_seq_tensor = char_seq_tensor[permIdx]
@@ -57,10 +83,36 @@ class CharBiLSTM(nn.Module):
         #  char_hidden[0] = h_t = (2, batch_size, lstm_dimension)
         # char_rnn_out, _ = pad_packed_sequence(char_rnn_out)
         ## transpose because the first dimension is num_direction x num-layer
-        hidden = char_hidden[0].transpose(1,0).contiguous().view(batch_size * sent_len, 1, -1)   ### before view, the size is ( batch_size * sent_len, 2, lstm_dimension) 2 means 2 direciton..
-        return hidden[recover_idx].view(batch_size, sent_len, -1)
+        hidden = char_hidden[0].transpose(1,0).contiguous().view(num_words, -1)   ### before view, the size is ( batch_size * sent_len, 2, lstm_dimension) 2 means 2 direciton..
+        return hidden[recover_idx]
+
+    def encode_cached(self, types, type_lens):
+        """
+        Features of the word types, only encoding the types which are not in the LRU cache.
+        The cache is only used in eval mode, and cleared when the model goes back to training.
+        """
+        keys = [tuple(chars[:length]) for chars, length in zip(types.tolist(), type_lens.tolist())]
+        missing = [idx for idx, key in enumerate(keys) if key not in self.cache]
+        if missing:
+            missing_idx = torch.tensor(missing, dtype=torch.long, device=types.device)
+            features = self.encode(types[missing_idx], type_lens[missing_idx]).detach()
+            for idx, feature in zip(missing, features):
+                self.cache[keys[idx]] = feature
+        for key in keys:
+            self.cache.move_to_end(key)
+        type_features = torch.stack([self.cache[key] for key in keys])
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return type_features
 
+    def train(self, mode=True):
+        ## the cached features are stale once the parameters are updated (also by `load_state_dict`)
+        self.cache.clear()
+        return super(CharBiLSTM, self).train(mode)
 
+    def _load_from_state_dict(self, *args, **kwargs):
+        self.cache.clear()
+        return super(CharBiLSTM, self)._load_from_state_dict(*args, **kwargs)
 
     def forward(self, char_input, seq_lengths):
         return self.get_last_hiddens(char_input, seq_lengths)
@@ -0,0 +1,62 @@
+#
+# @author: Allan
+#
+
+import torch
+
+
+class LogPartition(torch.autograd.Function):
+    """
+    Sum of the log partition functions of a batch, with the gradient computed by forward-backward:
+    d log Z / d emission = the unary marginals and d log Z / d transition = the expected transition counts.
+    Only the emissions and the (batch, seq_len, label_size) alphas are kept for the backward pass,
+    instead of autograd saving a (batch, label_size, label_size) tensor at every position.
+    The positions beyond the length of a sentence keep its alpha unchanged.
+    """
+
+    @staticmethod
+    def forward(ctx, features, transition, masks, start_idx: int, end_idx: int):
+        """
+        :param features: emission scores (batch, seq_len, label_size)
+        :param transition: (from_label, to_label)
+        :param masks: (batch, seq_len)
+        :return: sum of the log partition of the batch
+        """
+        seq_len = features.size(1)
+        alphas = torch.empty_like(features)
+        alpha = transition[start_idx, :].view(1, -1) + features[:, 0, :]
+        alphas[:, 0] = alpha
+        for word_idx in range(1, seq_len):
+            next_alpha = torch.logsumexp(alpha.unsqueeze(2) + transition.unsqueeze(0), dim=1) + features[:, word_idx, :]
+            alpha = torch.where(masks[:, word_idx].unsqueeze(1), next_alpha, alpha)
+            alphas[:, word_idx] = alpha
+        last_alpha = torch.logsumexp(alpha + transition[:, end_idx].view(1, -1), dim=1)
+        ctx.save_for_backward(features, transition, masks, alphas, last_alpha)
+        ctx.start_idx = start_idx
+        ctx.end_idx = end_idx
+        return torch.sum(last_alpha)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        features, transition, masks, alphas, log_partition = ctx.saved_tensors
+        batch_size, seq_len, label_size = features.size()
+        log_partition = log_partition.view(batch_size, 1)
+        end_scores = transition[:, ctx.end_idx].view(1, label_size).expand(batch_size, label_size)
+        grad_transition = torch.zeros_like(transition)
+        betas = torch.empty_like(features)
+        ## the beta of the last word of a sentence only has the transition to STOP
+        beta = end_scores
+        betas[:, seq_len - 1] = beta
+        for word_idx in range(seq_len - 1, 0, -1):
+            ## expected count of the transitions between the positions word_idx - 1 and word_idx
+            next_scores = (features[:, word_idx, :] + beta).unsqueeze(1)
+            log_pair = alphas[:, word_idx - 1].unsqueeze(2) + transition.unsqueeze(0) + next_scores - log_partition.view(batch_size, 1, 1)
+            ## the padded positions are dropped before exp, their (unbounded) emissions would overflow to inf
+            log_pair = torch.where(masks[:, word_idx].view(batch_size, 1, 1), log_pair, torch.full_like(log_pair, -float("inf")))
+            grad_transition += torch.exp(log_pair).sum(0)
+            beta = torch.where(masks[:, word_idx].unsqueeze(1), torch.logsumexp(transition.unsqueeze(0) + next_scores, dim=2), end_scores)
+            betas[:, word_idx - 1] = beta
+        marginals = torch.exp(alphas + betas - log_partition.view(batch_size, 1, 1)) * masks.unsqueeze(2).to(features.dtype)
+        grad_transition[ctx.start_idx, :] += marginals[:, 0].sum(0)
+        grad_transition[:, ctx.end_idx] += torch.exp(alphas[:, seq_len - 1] + end_scores - log_partition).sum(0)
+        return grad_output * marginals, grad_output * grad_transition, None, None, None
@@ -107,5 +107,54 @@ class DepLabeledGCN(nn.Module):
         outputs = self.out_mlp(gcn_inputs)
         return outputs
 
+    def forward_edges(self, gcn_inputs, word_seq_len, edges):
+        """
+        Same computation as `forward`, but with the dependency graph given as an edge list,
+        the neighbors are aggregated with `index_add_`, so memory and computation are O(N) instead of O(N^2).
+        :param gcn_inputs: (batch_size, sent_len, input_dim)
+        :param word_seq_len:
+        :param edges: (4, num_edges): sentence index, row, column and dependency label id of every edge
+        :return:
+        """
+        edges = edges.to(self.device)
+        batch_size, sent_len, input_dim = gcn_inputs.size()
+        rows = edges[0] * sent_len + edges[1]
+        cols = edges[0] * sent_len + edges[2]
+        num_nodes = batch_size * sent_len
+
+        ## the neighbors are summed in float32, the inputs are bfloat16 under autocast when the LSTM output is not padded
+        denom = torch.zeros(num_nodes, device=gcn_inputs.device, dtype=torch.float32).index_add_(0, rows, torch.ones_like(rows, dtype=torch.float32))
+        denom = denom.view(batch_size, sent_len, 1) + 1
+
+        dep_embs = self.dep_emb(edges[3]).view(-1).float()  ## num_edges
+        self_val = self.dep_emb(self.self_dep_label_id).float()
+        dep_denom = torch.zeros(num_nodes, device=gcn_inputs.device, dtype=torch.float32).index_add_(0, rows, dep_embs)
+        dep_denom = dep_denom.view(batch_size, sent_len, 1) + self_val
+
+        for l in range(self.layers):
+            flat_inputs = gcn_inputs.reshape(num_nodes, -1).float()
+            neighbors = flat_inputs[cols]
+            Ax = torch.zeros_like(flat_inputs).index_add_(0, rows, neighbors).view(batch_size, sent_len, -1)
+            AxW = self.W[l](Ax)
+            AxW = AxW + self.W[l](gcn_inputs)  ## self loop
+            AxW = AxW / denom
+
+            Bx = torch.zeros_like(flat_inputs).index_add_(0, rows, neighbors * dep_embs.unsqueeze(1)).view(batch_size, sent_len, -1)
+            BxW = self.W_label[l](Bx)
+            BxW = BxW + self.W_label[l](gcn_inputs * self_val)
+            BxW = BxW / dep_denom
+
+            if self.edge_gate:
+                gxW = self.gates[l](Ax)
+                gate_val = torch.sigmoid(gxW + self.gates[l](gcn_inputs))
+                gAxW = F.relu(gate_val * (AxW + BxW))
+            else:
+                gAxW = F.relu(AxW + BxW)
+
+            gcn_inputs = self.gcn_drop(gAxW) if l < self.layers - 1 else gAxW
+
+        outputs = self.out_mlp(gcn_inputs)
+        return outputs
+
 
 
@@ -0,0 +1,388 @@
+#
+# @author: Allan
+#
+
+import argparse
+import json
+import zipfile
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from typing import Final, List, Tuple
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+from config.config import Config, DepModelType, ContextEmb, InteractionFunction
+from model.lstmcrf import NNCRF
+from model.artifact import RUNTIME_ARGS
+
+"""
+TorchScript export: the eval-mode computation of a trained NNCRF (including the Viterbi decoding),
+specialized for its configuration so that the dependency model, the contextual embedding and the
+interaction function are constants of the module instead of branches on the enums.
+The exported file also contains the arguments and the index tables of the model (as json), it is
+loaded with `load_torchscript` and decodes the batches of `simple_batching` like `NNCRF.decode`.
+"""
+
+EXTRA_FILE = "nncrf.json"
+
+
+class ScriptedCharEncoder(nn.Module):
+    """
+    `CharBiLSTM.encode` without the dropout.
+    """
+
+    def __init__(self, char_feature):
+        super(ScriptedCharEncoder, self).__init__()
+        self.char_embeddings = char_feature.char_embeddings
+        self.char_lstm = char_feature.char_lstm
+
+    def forward(self, char_seq_tensor, char_seq_len):
+        batch_size = char_seq_tensor.size(0)
+        sent_len = char_seq_tensor.size(1)
+        num_words = batch_size * sent_len
+        char_seq_tensor = char_seq_tensor.view(num_words, -1)
+        char_seq_len = char_seq_len.view(num_words)
+        sorted_seq_len, permIdx = char_seq_len.sort(0, descending=True)
+        _, recover_idx = permIdx.sort(0, descending=False)
+        char_embeds = self.char_embeddings(char_seq_tensor[permIdx])
+        pack_input = pack_padded_sequence(char_embeds, sorted_seq_len.cpu(), batch_first=True)
+        _, char_hidden = self.char_lstm(pack_input)
+        hidden = char_hidden[0].transpose(1, 0).contiguous().view(num_words, -1)
+        return hidden[recover_idx].view(batch_size, sent_len, -1)
+
+
+class ScriptedGCNLayer(nn.Module):
+    edge_gate: Final[bool]
+
+    def __init__(self, W, W_label, gate):
+        super(ScriptedGCNLayer, self).__init__()
+        self.edge_gate = gate is not None
+        self.W = W
+        self.W_label = W_label
+        ## never called without the gate
+        self.gate = gate if gate is not None else W
+
+    def forward(self, gcn_inputs, Ax, Bx, denom, dep_denom, self_val):
+        AxW = (self.W(Ax) + self.W(gcn_inputs)) / denom
+        BxW = (self.W_label(Bx) + self.W_label(gcn_inputs * self_val)) / dep_denom
+        if self.edge_gate:
+            gate_val = torch.sigmoid(self.gate(Ax) + self.gate(gcn_inputs))
+            return F.relu(gate_val * (AxW + BxW))
+        return F.relu(AxW + BxW)
+
+
+class ScriptedGCN(nn.Module):
+    """
+    `DepLabeledGCN.forward` (dense adjacency matrices) or `DepLabeledGCN.forward_edges` (edge lists) without the dropout.
+    """
+    sparse: Final[bool]
+
+    def __init__(self, gcn, sparse: bool):
+        super(ScriptedGCN, self).__init__()
+        self.sparse = sparse
+        self.layers = nn.ModuleList([ScriptedGCNLayer(gcn.W[l], gcn.W_label[l], gcn.gates[l] if gcn.edge_gate else None) for l in range(gcn.layers)])
+        self.dep_emb = gcn.dep_emb
+        self.out_mlp = gcn.out_mlp
+        self.register_buffer("self_dep_label_id", gcn.self_dep_label_id.clone())
+
+    def forward(self, gcn_inputs, adj_matrix, dep_label_matrix, edges):
+        if self.sparse:
+            return self.forward_edges(gcn_inputs, edges)
+        denom = adj_matrix.sum(2).unsqueeze(2) + 1
+        dep_embs = self.dep_emb(dep_label_matrix).squeeze(3) * adj_matrix
+        self_val = self.dep_emb(self.self_dep_label_id)
+        dep_denom = dep_embs.sum(2).unsqueeze(2) + self_val
+        for layer in self.layers:
+            gcn_inputs = layer(gcn_inputs, adj_matrix.bmm(gcn_inputs), dep_embs.bmm(gcn_inputs), denom, dep_denom, self_val)
+        return self.out_mlp(gcn_inputs)
+
+    def forward_edges(self, gcn_inputs, edges):
+        batch_size = gcn_inputs.size(0)
+        sent_len = gcn_inputs.size(1)
+        rows = edges[0] * sent_len + edges[1]
+        cols = edges[0] * sent_len + edges[2]
+        num_nodes = batch_size * sent_len
+        denom = torch.zeros(num_nodes, device=gcn_inputs.device).index_add_(0, rows, torch.ones_like(rows, dtype=gcn_inputs.dtype))
+        denom = denom.view(batch_size, sent_len, 1) + 1
+        dep_embs = self.dep_emb(edges[3]).view(-1)
+        self_val = self.dep_emb(self.self_dep_label_id)
+        dep_denom = torch.zeros(num_nodes, device=gcn_inputs.device, dtype=dep_embs.dtype).index_add_(0, rows, dep_embs)
+        dep_denom = dep_denom.view(batch_size, sent_len, 1) + self_val
+        for layer in self.layers:
+            flat_inputs = gcn_inputs.reshape(num_nodes, -1)
+            neighbors = flat_inputs[cols]
+            Ax = torch.zeros_like(flat_inputs).index_add_(0, rows, neighbors).view(batch_size, sent_len, -1)
+            Bx = torch.zeros_like(flat_inputs).index_add_(0, rows, neighbors * dep_embs.unsqueeze(1)).view(batch_size, sent_len, -1)
+            gcn_inputs = layer(gcn_inputs, Ax, Bx, denom, dep_denom, self_val)
+        return self.out_mlp(gcn_inputs)
+
+
+class ScriptedDGLSTMLayer(nn.Module):
+    """
+    One of the additional LSTM layers of the dglstm model, with the interaction of the head representation.
+    """
+    interaction: Final[int]
+
+    def __init__(self, lstm, interaction: int, mlp_layer=None, mlp_head_linear=None):
+        super(ScriptedDGLSTMLayer, self).__init__()
+        self.lstm = lstm
+        self.interaction = interaction
+        self.mlp_layer = mlp_layer if mlp_layer is not None else nn.Identity()
+        self.mlp_head_linear = mlp_head_linear if mlp_head_linear is not None else nn.Identity()
+
+    def forward(self, feature_out, dep_head_emb, sorted_seq_len):
+        if self.interaction == 0:
+            feature_out = torch.cat((feature_out, dep_head_emb), 2)
+        elif self.interaction == 1:
+            feature_out = feature_out + dep_head_emb
+        else:
+            feature_out = F.relu(self.mlp_layer(feature_out) + self.mlp_head_linear(dep_head_emb))
+        packed_words = pack_padded_sequence(feature_out, sorted_seq_len, batch_first=True)
+        lstm_out, _ = self.lstm(packed_words)
+        lstm_out, _ = pad_packed_sequence(lstm_out, batch_first=True)
+        return lstm_out
+
+
+class ScriptedNNCRF(nn.Module):
+    """
+    `NNCRF.neural_scoring` and `NNCRF.viterbiDecode` in eval mode, for one configuration.
+    The unused inputs of `forward` can be empty tensors.
+    """
+    use_char: Final[bool]
+    dglstm: Final[bool]
+    dggcn: Final[bool]
+    use_context_emb: Final[bool]
+    use_lstm: Final[bool]
+    iobes_constraint: Final[bool]
+    start_idx: Final[int]
+    end_idx: Final[int]
+    lstm_hidden_dim: Final[int]
+
+    def __init__(self, config: Config, model: NNCRF):
+        super(ScriptedNNCRF, self).__init__()
+        self.use_char = bool(model.use_char)
+        self.dglstm = model.dep_model == DepModelType.dglstm
+        self.dggcn = model.dep_model == DepModelType.dggcn
+        self.use_context_emb = model.context_emb != ContextEmb.none
+        self.use_lstm = model.num_lstm_layer > 0
+        self.iobes_constraint = bool(model.iobes_constraint)
+        self.start_idx = model.start_idx
+        self.end_idx = model.end_idx
+        self.lstm_hidden_dim = model.lstm_hidden_dim
+
+        self.word_embedding = model.word_embedding
+        if self.use_char:
+            self.char_feature = ScriptedCharEncoder(model.char_feature)
+        if self.dglstm or self.dggcn:
+            self.dep_label_embedding = model.dep_label_embedding
+        if self.use_lstm:
+            self.lstm = model.lstm
+        add_layers = []
+        if self.dglstm and model.num_lstm_layer > 1:
+            interaction = model.interaction_func.value
+            for l in range(model.num_lstm_layer - 1):
+                if model.interaction_func == InteractionFunction.mlp:
+                    add_layers.append(ScriptedDGLSTMLayer(model.add_lstms[l], interaction, model.mlp_layers[l], model.mlp_head_linears[l]))
+                else:
+                    add_layers.append(ScriptedDGLSTMLayer(model.add_lstms[l], interaction))
+        self.add_layers = nn.ModuleList(add_layers)
+        if self.dggcn:
+            self.gcn = ScriptedGCN(model.gcn, config.gcn_graph == "sparse")
+        self.hidden2tag = model.hidden2tag
+
+        ## the CRF parameters are frozen
+        self.register_buffer("transition", model.get_transition().detach().clone())
+        if self.iobes_constraint:
+            self.register_buffer("decode_labels", model.decode_labels.clone())
+
+    def forward(self, word_seq_tensor, word_seq_lens, context_emb, char_inputs, char_seq_lens, dep_head_tensor, dep_label_tensor,
+                adj_matrixs, dep_label_adj, graphs) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        :return: the best scores (batch, 1) and the best label sequences (batch, seq_len), padded with 0
+        """
+        features = self.neural_scoring(word_seq_tensor, word_seq_lens, context_emb, char_inputs, char_seq_lens, dep_head_tensor, dep_label_tensor,
+                                       adj_matrixs, dep_label_adj, graphs)
+        return self.viterbi_decode(features, word_seq_lens)
+
+    def neural_scoring(self, word_seq_tensor, word_seq_lens, context_emb, char_inputs, char_seq_lens, dep_head_tensor, dep_label_tensor,
+                       adj_matrixs, dep_label_adj, graphs):
+        batch_size = word_seq_tensor.size(0)
+        sent_len = word_seq_tensor.size(1)
+        word_emb = self.word_embedding(word_seq_tensor)
+        char_features = word_emb
+        if self.use_char:
+            char_features = self.char_feature(char_inputs, char_seq_lens)
+        dep_head_emb = word_emb
+        if self.dglstm:
+            if self.use_char:
+                word_emb = torch.cat((word_emb, char_features), 2)
+            dep_head_emb = torch.gather(word_emb, 1, dep_head_tensor.view(batch_size, sent_len, 1).expand(batch_size, sent_len, word_emb.size(2)))
+        if self.use_context_emb:
+            word_emb = torch.cat((word_emb, context_emb.to(word_emb.device)), 2)
+        if self.use_char and not self.dglstm:
+            word_emb = torch.cat((word_emb, char_features), 2)
+        if self.dglstm:
+            word_emb = torch.cat((word_emb, dep_head_emb, self.dep_label_embedding(dep_label_tensor)), 2)
+
+        sorted_seq_len, permIdx = word_seq_lens.sort(0, descending=True)
+        _, recover_idx = permIdx.sort(0, descending=False)
+        feature_out = word_emb[permIdx]
+        sorted_seq_len = sorted_seq_len.cpu()
+        if self.use_lstm:
+            packed_words = pack_padded_sequence(feature_out, sorted_seq_len, batch_first=True)
+            lstm_out, _ = self.lstm(packed_words)
+            feature_out, _ = pad_packed_sequence(lstm_out, batch_first=True)
+        if self.dglstm:
+            sorted_heads = dep_head_tensor[permIdx].view(batch_size, sent_len, 1).expand(batch_size, sent_len, self.lstm_hidden_dim)
+            for layer in self.add_layers:
+                feature_out = layer(feature_out, torch.gather(feature_out, 1, sorted_heads), sorted_seq_len)
+        if self.dggcn:
+            if self.gcn.sparse:
+                ## the edges refer to the sentence index before sorting
+                graphs = graphs.clone()
+                graphs[0] = recover_idx.to(graphs.device)[graphs[0]]
+                feature_out = self.gcn(feature_out, adj_matrixs, dep_label_adj, graphs.to(feature_out.device))
+            else:
+                feature_out = self.gcn(feature_out, adj_matrixs[permIdx].to(feature_out.device), dep_label_adj[permIdx].to(feature_out.device), graphs)
+        outputs = self.hidden2tag(feature_out)
+        return outputs[recover_idx]
+
+    def viterbi_decode(self, features, word_seq_lens):
+        """
+        Same as `NNCRF.viterbiDecode`, with the backtrace in torch.
+        """
+        batchSize = features.size(0)
+        sentLength = features.size(1)
+        sorted_lens, permIdx = word_seq_lens.cpu().sort(0, descending=True)
+        features = features[permIdx.to(features.device)]
+        transition = self.transition
+        start_scores = transition[self.start_idx, :]
+        end_scores = transition[:, self.end_idx]
+        if self.iobes_constraint:
+            features = features[:, :, self.decode_labels]
+            start_scores = start_scores[self.decode_labels]
+            end_scores = end_scores[self.decode_labels]
+            transition = transition[self.decode_labels][:, self.decode_labels]
+        num_labels = transition.size(0)
+        max_len = int(sorted_lens[0])
+        backpointers = torch.zeros([sentLength, batchSize, num_labels], dtype=torch.long, device=features.device)
+        transition = transition.view(1, num_labels, num_labels)
+        scores = start_scores.view(1, num_labels) + features[:, 0, :]
+        for wordIdx in range(1, max_len):
+            active = int((sorted_lens > wordIdx).sum())
+            scoresIdx = scores[:active].unsqueeze(2) + transition + features[:active, wordIdx, :].unsqueeze(1)
+            bestIdx, bestPrev = torch.max(scoresIdx, 1)
+            backpointers[wordIdx, :active] = bestPrev
+            scores = torch.cat([bestIdx, scores[active:]], 0)
+        lastScores = scores + end_scores.view(1, num_labels)
+        bestScores, lastIdx = torch.max(lastScores, 1)
+
+        backpointers = backpointers.cpu()
+        decodeIdx = torch.zeros([batchSize, sentLength], dtype=torch.long)
+        current = lastIdx.cpu()
+        rows = torch.arange(batchSize)
+        decodeIdx[rows, sorted_lens - 1] = current
+        for wordIdx in range(max_len - 1, 0, -1):
+            active = int((sorted_lens > wordIdx).sum())
+            current = torch.cat([backpointers[wordIdx, rows[:active], current[:active]], current[active:]], 0)
+            decodeIdx[:active, wordIdx - 1] = current[:active]
+        if self.iobes_constraint:
+            valid = torch.arange(sentLength).view(1, sentLength) < sorted_lens.view(batchSize, 1)
+            decodeIdx[valid] = self.decode_labels.cpu()[decodeIdx[valid]]
+        _, recover_idx = permIdx.sort(0)
+        return bestScores.view(batchSize, 1)[recover_idx.to(bestScores.device)], decodeIdx[recover_idx]
+
+
+def scripted_inputs(batchInput, device) -> List[torch.Tensor]:
+    """
+    The inputs of `ScriptedNNCRF.forward` from a batch of `simple_batching`, empty tensors for the missing ones.
+    """
+    wordSeqTensor, wordSeqLengths, batch_context_emb, charSeqTensor, charSeqLengths, adj_matrixs, adjs_in, adjs_out, graphs, dep_label_adj, batch_dep_heads, trees, tagSeqTensor, batch_dep_label = batchInput
+    empty = torch.empty(0, device=device)
+    return [wordSeqTensor, wordSeqLengths, batch_context_emb if batch_context_emb is not None else empty, charSeqTensor, charSeqLengths,
+            batch_dep_heads, batch_dep_label, adj_matrixs if adj_matrixs is not None else empty,
+            dep_label_adj if dep_label_adj is not None else empty, graphs if graphs is not None else empty]
+
+
+class ScriptedModel:
+    """
+    Runs an exported module in place of `NNCRF` for decoding (`Predictor`, `predict_file`, `evaluate`).
+    """
+
+    def __init__(self, module, device):
+        self.module = module
+        self.device = device
+        self.feature_table = None
+
+    def eval(self):
+        return self
+
+    def decode(self, batchInput):
+        with torch.no_grad():
+            return self.module(*scripted_inputs(batchInput, self.device))
+
+
+def export_torchscript(config: Config, model: NNCRF, path: str, batches, freeze: bool = True):
+    """
+    Script the model for its configuration, check that it decodes `batches` exactly like the eager
+    model and save it with the arguments and the index tables.
+    :param batches: batches of `simple_batching` for the parity check
+    """
+    model.eval()
+    module = torch.jit.script(ScriptedNNCRF(config, model).eval())
+    if freeze:
+        ## no numerical rewriting, so that the predictions stay the same
+        module = torch.jit.freeze(module, optimize_numerics=False)
+    ## the parity check is against the plain eager computation
+    feature_table, dedup = model.feature_table, model.char_feature.dedup if model.use_char else 0
+    model.feature_table = None
+    if model.use_char:
+        model.char_feature.dedup = 0
+    num_sents = 0
+    with torch.no_grad():
+        for batch in batches:
+            eager_scores, eager_ids = model.decode(batch)
+            scores, ids = module(*scripted_inputs(batch, config.device))
+            if not torch.equal(eager_ids, ids):
+                raise RuntimeError("the exported model does not decode like the eager model")
+            if not torch.allclose(eager_scores, scores, rtol=1e-5, atol=1e-4):
+                raise RuntimeError("the exported model does not score like the eager model: max difference %.6f" % (eager_scores - scores).abs().max().item())
+            num_sents += batch[0].size(0)
+    model.feature_table = feature_table
+    if model.use_char:
+        model.char_feature.dedup = dedup
+    print("[Export] %d sentences decoded identically by the exported model" % (num_sents))
+    metadata = {"args": config.args, "vocab": config.get_vocab(), "embedding_dim": config.embedding_dim, "context_emb_size": config.context_emb_size}
+    torch.jit.save(module, path, _extra_files={EXTRA_FILE: json.dumps(metadata)})
+    print("[Export] TorchScript model saved to: %s" % (path))
+    return module
+
+
+def is_torchscript(path: str) -> bool:
+    if not zipfile.is_zipfile(path):
+        return False
+    with zipfile.ZipFile(path) as archive:
+        return any(name.endswith("extra/" + EXTRA_FILE) for name in archive.namelist())
+
+
+def load_torchscript(path: str, args: argparse.Namespace = None) -> Tuple[Config, ScriptedModel]:
+    """
+    :param args: arguments of the current run, for the options in `RUNTIME_ARGS`
+    :return: the config (with the index tables) and the model of an exported file
+    :raise ValueError: if the file does not have the embedding sizes of the model
+    """
+    device = args.device if args is not None else "cpu"
+    extra_files = {EXTRA_FILE: ""}
+    module = torch.jit.load(path, map_location=device, _extra_files=extra_files)
+    metadata = json.loads(extra_files[EXTRA_FILE])
+    saved_args = dict(metadata["args"])
+    if args is not None:
+        for key, value in vars(args).items():
+            if key in RUNTIME_ARGS or key not in saved_args:
+                saved_args[key] = value
+    config = Config(argparse.Namespace(**saved_args))
+    config.set_vocab(metadata["vocab"])
+    if "embedding_dim" not in metadata or "context_emb_size" not in metadata:
+        raise ValueError("{} has no embedding sizes in its metadata, export the model again with --mode export".format(path))
+    config.embedding_dim = metadata["embedding_dim"]
+    config.context_emb_size = metadata["context_emb_size"]
+    return config, ScriptedModel(module, config.device)
@@ -5,12 +5,14 @@
 import torch
 import torch.nn as nn
 
-from config.utils import START, STOP, PAD, log_sum_exp_pytorch
+from config.utils import START, STOP, PAD, allowed_transitions, reachable_labels
 from model.charbilstm import CharBiLSTM
+from model.crf import LogPartition
 from model.deplabel_gcn import DepLabeledGCN
 from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 from config.config import DepModelType, ContextEmb, InteractionFunction
 import torch.nn.functional as F
+import numpy as np
 
 class NNCRF(nn.Module):
 
@@ -23,6 +25,7 @@ class NNCRF(nn.Module):
         self.dep_model = config.dep_model
         self.context_emb = config.context_emb
         self.interaction_func = config.interaction_func
+        self.crf_scan = config.crf_scan
 
 
         self.label2idx = config.label2idx
@@ -115,6 +118,78 @@ class NNCRF(nn.Module):
 
         self.transition = nn.Parameter(init_transition)
 
+        self.iobes_constraint = config.iobes_constraint
+        if self.iobes_constraint:
+            allowed = torch.from_numpy(allowed_transitions(self.labels, self.start_idx, self.end_idx))
+            print("[Model Info] IOBES constraint: {} of {} transitions allowed".format(int(allowed.sum()), self.label_size * self.label_size))
+            ## added to the transition scores, so the illegal transitions never get probability mass
+            self.transition_mask = ((~allowed).float() * -10000.0).to(self.device)
+            ## decode only over the labels reachable from START (i.e., without PAD, START and STOP)
+            self.decode_labels = torch.from_numpy(reachable_labels(allowed.numpy(), self.start_idx, self.end_idx)).to(self.device)
+
+        ## per word type [word embedding; char features] for inference, see `build_feature_table`
+        self.feature_table = None
+        self.unk_id = config.unk_id
+
+    def get_transition(self):
+        """
+        :return: the transition scores (from_label, to_label), with the illegal transitions masked under the IOBES constraint
+        """
+        if self.iobes_constraint:
+            return self.transition + self.transition_mask
+        return self.transition
+
+    def build_feature_table(self, config, batch_size: int = 2048):
+        """
+        Precompute the word embedding and the char features of every word of the vocabulary into one
+        frozen table, used instead of the embedding lookup and the char LSTM in eval mode.
+        The unknown words are still encoded by the char LSTM. The table is dropped when training again.
+        """
+        self.eval()
+        weight = self.word_embedding.weight.detach().float()
+        if not self.use_char:
+            self.feature_table = weight.clone()
+            return self.feature_table
+        pad_char_id = config.char2idx[PAD]
+        unk_char_id = config.char2idx[config.UNK]
+        ## the padding tokens have a single padding character (see `simple_batching`)
+        char_ids = [[pad_char_id] if word == PAD else [config.char2idx.get(c, unk_char_id) for c in word] for word in config.idx2word]
+        char_features = []
+        with torch.no_grad():
+            for start in range(0, len(char_ids), batch_size):
+                chunk = char_ids[start:start + batch_size]
+                lens = torch.tensor([max(1, len(chars)) for chars in chunk], dtype=torch.long)
+                chars = torch.zeros((len(chunk), int(lens.max())), dtype=torch.long)
+                for idx, word_chars in enumerate(chunk):
+                    chars[idx, :len(word_chars)] = torch.tensor(word_chars, dtype=torch.long)
+                char_features.append(self.char_feature.encode(chars.to(self.device), lens.to(self.device)))
+        self.feature_table = torch.cat((weight, torch.cat(char_features, 0)), 1)
+        return self.feature_table
+
+    def lookup_feature_table(self, word_seq_tensor, char_inputs, char_seq_lens):
+        """
+        :return: the word embeddings (batch_size, sent_len, embedding_dim) and the char features (batch_size, sent_len, charlstm_dim) from the table
+        """
+        features = self.feature_table[word_seq_tensor]
+        word_emb = features[:, :, :self.embedding_dim]
+        if not self.use_char:
+            return word_emb, None
+        char_features = features[:, :, self.embedding_dim:]
+        unk = (word_seq_tensor == self.unk_id).nonzero(as_tuple=True)
+        if unk[0].numel() > 0:
+            char_features = char_features.clone()
+            char_features[unk] = self.char_feature.get_last_hiddens(char_inputs[unk].unsqueeze(0), char_seq_lens[unk].unsqueeze(0)).squeeze(0)
+        return word_emb, char_features
+
+    def train(self, mode=True):
+        if mode:
+            self.feature_table = None
+        return super(NNCRF, self).train(mode)
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        ## the table is built from the previous weights
+        self.feature_table = None
+        return super(NNCRF, self)._load_from_state_dict(*args, **kwargs)
 
     def neural_scoring(self, word_seq_tensor, word_seq_lens, batch_context_emb, char_inputs, char_seq_lens, adj_matrixs, adjs_in, adjs_out, graphs, dep_label_adj, dep_head_tensor, dep_label_tensor, trees=None):
         """
@@ -128,10 +203,14 @@ class NNCRF(nn.Module):
         batch_size = word_seq_tensor.size(0)
         sent_len = word_seq_tensor.size(1)
 
-        word_emb = self.word_embedding(word_seq_tensor)
+        if self.feature_table is not None and not self.training:
+            word_emb, char_features = self.lookup_feature_table(word_seq_tensor, char_inputs, char_seq_lens)
+        else:
+            word_emb = self.word_embedding(word_seq_tensor)
+            if self.use_char:
+                char_features = self.char_feature.get_last_hiddens(char_inputs, char_seq_lens)
         if self.use_char:
             if self.dep_model == DepModelType.dglstm:
-                char_features = self.char_feature.get_last_hiddens(char_inputs, char_seq_lens)
                 word_emb = torch.cat((word_emb, char_features), 2)
         if self.dep_model == DepModelType.dglstm:
             size = self.embedding_dim if not self.use_char else (self.embedding_dim + self.charlstm_dim)
@@ -142,7 +221,6 @@ class NNCRF(nn.Module):
 
         if self.use_char:
             if self.dep_model != DepModelType.dglstm:
-                char_features = self.char_feature.get_last_hiddens(char_inputs, char_seq_lens)
                 word_emb = torch.cat((word_emb, char_features), 2)
 
         """
@@ -188,7 +266,12 @@ class NNCRF(nn.Module):
         """
         Model forward if we have GCN
         """
-        if self.dep_model == DepModelType.dggcn:
+        if self.dep_model == DepModelType.dggcn and graphs is not None:
+            ## the edges refer to the sentence index before sorting
+            graphs = graphs.clone()
+            graphs[0] = recover_idx.to(graphs.device)[graphs[0]]
+            feature_out = self.gcn.forward_edges(feature_out, sorted_seq_len, graphs)
+        elif self.dep_model == DepModelType.dggcn:
             feature_out = self.gcn(feature_out, sorted_seq_len, adj_matrixs[permIdx], dep_label_adj[permIdx])
 
         outputs = self.hidden2tag(feature_out)
@@ -198,103 +281,246 @@ class NNCRF(nn.Module):
     def calculate_all_scores(self, features):
         batch_size = features.size(0)
         seq_len = features.size(1)
-        scores = self.transition.view(1, 1, self.label_size, self.label_size).expand(batch_size, seq_len, self.label_size, self.label_size) + \
+        scores = self.get_transition().view(1, 1, self.label_size, self.label_size).expand(batch_size, seq_len, self.label_size, self.label_size) + \
                     features.view(batch_size, seq_len, 1, self.label_size).expand(batch_size,seq_len,self.label_size, self.label_size)
         return scores
 
-    def forward_unlabeled(self, all_scores, word_seq_lens, masks):
-        batch_size = all_scores.size(0)
-        seq_len = all_scores.size(1)
-        alpha = torch.zeros(batch_size, seq_len, self.label_size).to(self.device)
-
-        alpha[:, 0, :] = all_scores[:, 0,  self.start_idx, :] ## the first position of all labels = (the transition from start - > all labels) + current emission.
-
-        for word_idx in range(1, seq_len):
-            ## batch_size, self.label_size, self.label_size
-            before_log_sum_exp = alpha[:, word_idx-1, :].view(batch_size, self.label_size, 1).expand(batch_size, self.label_size, self.label_size) + all_scores[:, word_idx, :, :]
-            alpha[:, word_idx, :] = log_sum_exp_pytorch(before_log_sum_exp)
-
-        ### batch_size x label_size
-        last_alpha = torch.gather(alpha, 1, word_seq_lens.view(batch_size, 1, 1).expand(batch_size, 1, self.label_size)-1).view(batch_size, self.label_size)
-        last_alpha += self.transition[:, self.end_idx].view(1, self.label_size).expand(batch_size, self.label_size)
-        last_alpha = log_sum_exp_pytorch(last_alpha.view(batch_size, self.label_size, 1)).view(batch_size)
+    def forward_unlabeled(self, features, word_seq_lens, masks):
+        """
+        Log partition function, computed with a running (batch_size, label_size) alpha vector.
+        The emissions and the transitions are only combined inside each step, and the gradient is computed
+        by forward-backward (see `LogPartition`), so only the (batch, seq_len, label_size) alphas are kept for the backward pass.
+        :param features: emission scores (batch, seq_len, label_size)
+        :param word_seq_lens: (batch)
+        :param masks: (batch, seq_len)
+        :return: sum of the log partition of the batch
+        """
+        if self.crf_scan:
+            return self.forward_unlabeled_scan(features, word_seq_lens, masks)
+        return LogPartition.apply(features, self.get_transition(), masks, self.start_idx, self.end_idx)
 
+    def forward_unlabeled_scan(self, features, word_seq_lens, masks):
+        """
+        Log partition function with a parallel (associative) scan in the log semiring:
+        the transition matrices of all positions are multiplied pairwise in a tree, O(log T) sequential steps,
+        at the cost of O(T x label_size^3) memory.
+        """
+        batch_size = features.size(0)
+        seq_len = features.size(1)
+        transition = self.get_transition()
+        alpha = transition[self.start_idx, :].view(1, self.label_size) + features[:, 0, :]
+        if seq_len > 1:
+            ## padded positions become the identity matrix of the log semiring
+            identity = torch.full((self.label_size, self.label_size), -10000.0, device=features.device, dtype=features.dtype)
+            identity.fill_diagonal_(0)
+            matrices = torch.where(masks[:, 1:].view(batch_size, seq_len - 1, 1, 1), self.calculate_all_scores(features[:, 1:]), identity)
+            while matrices.size(1) > 1:
+                rest = matrices[:, -1:] if matrices.size(1) % 2 == 1 else None
+                even = matrices[:, 0:matrices.size(1) - 1:2] if rest is not None else matrices[:, 0::2]
+                odd = matrices[:, 1::2]
+                ## (batch, n, from, mid, 1) + (batch, n, 1, mid, to)
+                matrices = torch.logsumexp(even.unsqueeze(4) + odd.unsqueeze(2), dim=3)
+                if rest is not None:
+                    matrices = torch.cat([matrices, rest], dim=1)
+            alpha = torch.logsumexp(alpha.unsqueeze(2) + matrices[:, 0], dim=1)
+        last_alpha = torch.logsumexp(alpha + transition[:, self.end_idx].view(1, self.label_size), dim=1)
         return torch.sum(last_alpha)
 
-    def forward_labeled(self, all_scores, word_seq_lens, tags, masks):
+    def forward_labeled(self, features, word_seq_lens, tags, masks):
         '''
-        :param all_scores: (batch, seq_len, label_size, label_size)
-        :param word_seq_lens: (batch, seq_len)
+        Score of the gold sequences, by indexing the emissions and the transitions directly.
+        :param features: emission scores (batch, seq_len, label_size)
+        :param word_seq_lens: (batch)
         :param tags: (batch, seq_len)
         :param masks: batch, seq_len
         :return: sum of score for the gold sequences
         '''
-        batchSize = all_scores.shape[0]
-        sentLength = all_scores.shape[1]
-
-        ## all the scores to current labels: batch, seq_len, all_from_label?
-        currentTagScores = torch.gather(all_scores, 3, tags.view(batchSize, sentLength, 1, 1).expand(batchSize, sentLength, self.label_size, 1)).view(batchSize, -1, self.label_size)
-        if sentLength != 1:
-            tagTransScoresMiddle = torch.gather(currentTagScores[:, 1:, :], 2, tags[:, : sentLength - 1].view(batchSize, sentLength - 1, 1)).view(batchSize, -1)
-        tagTransScoresBegin = currentTagScores[:, 0, self.start_idx]
-        endTagIds = torch.gather(tags, 1, word_seq_lens.view(batchSize, 1) - 1)
-        tagTransScoresEnd = torch.gather(self.transition[:, self.end_idx].view(1, self.label_size).expand(batchSize, self.label_size), 1,  endTagIds).view(batchSize)
-        score = torch.sum(tagTransScoresBegin) + torch.sum(tagTransScoresEnd)
+        batchSize = features.shape[0]
+        sentLength = features.shape[1]
+
+        transition = self.get_transition()
+        emissionScores = torch.gather(features, 2, tags.view(batchSize, sentLength, 1)).view(batchSize, sentLength)
+        tagTransScoresBegin = transition[self.start_idx, tags[:, 0]]
+        endTagIds = torch.gather(tags, 1, word_seq_lens.view(batchSize, 1) - 1).view(batchSize)
+        tagTransScoresEnd = transition[endTagIds, self.end_idx]
+        score = torch.sum(tagTransScoresBegin) + torch.sum(tagTransScoresEnd) + torch.sum(emissionScores.masked_select(masks))
         if sentLength != 1:
+            tagTransScoresMiddle = transition[tags[:, : sentLength - 1], tags[:, 1:]]
             score += torch.sum(tagTransScoresMiddle.masked_select(masks[:, 1:]))
         return score
 
     def neg_log_obj(self, words, word_seq_lens, batch_context_emb, chars, char_seq_lens, adj_matrixs, adjs_in, adjs_out, graphs, dep_label_adj, batch_dep_heads, tags, batch_dep_label, trees=None):
         features = self.neural_scoring(words, word_seq_lens, batch_context_emb, chars, char_seq_lens, adj_matrixs, adjs_in, adjs_out, graphs, dep_label_adj, batch_dep_heads, batch_dep_label, trees)
 
-        all_scores = self.calculate_all_scores(features)
-
         batch_size = words.size(0)
         sent_len = words.size(1)
 
         maskTemp = torch.arange(1, sent_len + 1, dtype=torch.long).view(1, sent_len).expand(batch_size, sent_len).to(self.device)
         mask = torch.le(maskTemp, word_seq_lens.view(batch_size, 1).expand(batch_size, sent_len)).to(self.device)
 
-        unlabed_score = self.forward_unlabeled(all_scores, word_seq_lens, mask)
-        labeled_score = self.forward_labeled(all_scores, word_seq_lens, tags, mask)
+        ## the CRF is computed in float32, also under autocast (the logsumexp recursion is not stable in bfloat16)
+        features = features.float()
+        with torch.autocast(features.device.type, enabled=False):
+            unlabed_score = self.forward_unlabeled(features, word_seq_lens, mask)
+            labeled_score = self.forward_labeled(features, word_seq_lens, tags, mask)
         return unlabed_score - labeled_score
 
 
-    def viterbiDecode(self, all_scores, word_seq_lens):
-        batchSize = all_scores.shape[0]
-        sentLength = all_scores.shape[1]
-        # sent_len =
-        scoresRecord = torch.zeros([batchSize, sentLength, self.label_size]).to(self.device)
-        idxRecord = torch.zeros([batchSize, sentLength, self.label_size], dtype=torch.int64).to(self.device)
-        mask = torch.ones_like(word_seq_lens, dtype=torch.int64).to(self.device)
-        startIds = torch.full((batchSize, self.label_size), self.start_idx, dtype=torch.int64).to(self.device)
-        decodeIdx = torch.LongTensor(batchSize, sentLength).to(self.device)
-
-        scores = all_scores
-        # scoresRecord[:, 0, :] = self.getInitAlphaWithBatchSize(batchSize).view(batchSize, self.label_size)
-        scoresRecord[:, 0, :] = scores[:, 0, self.start_idx, :]  ## represent the best current score from the start, is the best
-        idxRecord[:,  0, :] = startIds
+    def viterbiDecode(self, features, word_seq_lens):
+        """
+        Batched Viterbi decoding. The sentences are processed in descending length order and each step
+        only runs over the sentences that are still active, the backpointers are kept as uint8/int16
+        and the backtrace is done in numpy on CPU.
+        :param features: emission scores (batch, seq_len, label_size)
+        :param word_seq_lens: (batch)
+        :return: the best scores (batch, 1) and the best label sequences (batch, seq_len) in forward order, padded with 0
+        """
+        batchSize = features.shape[0]
+        sentLength = features.shape[1]
+        sorted_lens, permIdx = word_seq_lens.cpu().sort(0, descending=True)
+        sorted_lens = sorted_lens.numpy()
+        features = features[permIdx.to(features.device)]
+        transition = self.get_transition()
+        start_scores = transition[self.start_idx, :]
+        end_scores = transition[:, self.end_idx]
+        if self.iobes_constraint:
+            ## compact label space: the unreachable labels are pruned
+            features = features[:, :, self.decode_labels]
+            start_scores = start_scores[self.decode_labels]
+            end_scores = end_scores[self.decode_labels]
+            transition = transition[self.decode_labels][:, self.decode_labels]
+        num_labels = transition.size(0)
+        bp_dtype = torch.uint8 if num_labels <= 256 else torch.int16
+        backpointers = torch.zeros([sentLength, batchSize, num_labels], dtype=bp_dtype, device=features.device)
+
+        transition = transition.view(1, num_labels, num_labels)
+        scores = start_scores.view(1, num_labels) + features[:, 0, :]  ## represent the best current score from the start, is the best
+        for wordIdx in range(1, int(sorted_lens[0])):
+            active = int((sorted_lens > wordIdx).sum())
+            ### scoresIdx: active x from_label x to_label at current index.
+            scoresIdx = scores[:active].unsqueeze(2) + transition + features[:active, wordIdx, :].unsqueeze(1)
+            bestIdx, bestPrev = torch.max(scoresIdx, 1)  ## the best previous label idx to current labels
+            backpointers[wordIdx, :active] = bestPrev.to(bp_dtype)
+            scores = torch.cat([bestIdx, scores[active:]], 0)
+
+        lastScores = scores + end_scores.view(1, num_labels)
+        bestScores, lastIdx = torch.max(lastScores, 1)
+
+        backpointers = backpointers.cpu().numpy().astype(np.int64)
+        decodeIdx = np.zeros([batchSize, sentLength], dtype=np.int64)
+        current = lastIdx.cpu().numpy()
+        rows = np.arange(batchSize)
+        decodeIdx[rows, sorted_lens - 1] = current
+        for wordIdx in range(int(sorted_lens[0]) - 1, 0, -1):
+            active = int((sorted_lens > wordIdx).sum())
+            current[:active] = backpointers[wordIdx, rows[:active], current[:active]]
+            decodeIdx[:active, wordIdx - 1] = current[:active]
+        if self.iobes_constraint:
+            valid = np.arange(sentLength)[None, :] < sorted_lens[:, None]
+            decodeIdx[valid] = self.decode_labels.cpu().numpy()[decodeIdx[valid]]
+
+        _, recover_idx = permIdx.sort(0)
+        return bestScores.view(batchSize, 1)[recover_idx.to(bestScores.device)], torch.from_numpy(decodeIdx)[recover_idx]
+
+    def viterbiDecodeNBest(self, features, word_seq_lens, k):
+        """
+        Batched k-best Viterbi decoding: for every label, the k best partial paths ending in it are kept.
+        :param features: emission scores (batch, seq_len, label_size)
+        :param word_seq_lens: (batch)
+        :param k: number of best paths
+        :return: the scores (batch, k) and the label sequences (batch, k, seq_len) in forward order, padded with 0.
+                 The paths through the special labels (START, STOP, PAD) are not excluded: the masked transitions
+                 only give them low but finite scores (-10000). A score is -inf only if a sentence has fewer than k
+                 label sequences at all.
+        """
+        batchSize = features.shape[0]
+        sentLength = features.shape[1]
+        transition = self.get_transition()
+        device = features.device
+        maskTemp = torch.arange(sentLength, device=device).view(1, sentLength)
+        masks = maskTemp < word_seq_lens.to(device).view(batchSize, 1)
+
+        scores = torch.full((batchSize, self.label_size, k), -float("Inf"), device=device, dtype=features.dtype)
+        scores[:, :, 0] = transition[self.start_idx, :].view(1, self.label_size) + features[:, 0, :]
+        ## for the padded positions every path points to itself
+        keep_labels = torch.arange(self.label_size, device=device).view(1, self.label_size, 1).expand(batchSize, self.label_size, k)
+        keep_ranks = torch.arange(k, device=device).view(1, 1, k).expand(batchSize, self.label_size, k)
+        prev_labels = []
+        prev_ranks = []
         for wordIdx in range(1, sentLength):
-            ### scoresIdx: batch x from_label x to_label at current index.
-            scoresIdx = scoresRecord[:, wordIdx - 1, :].view(batchSize, self.label_size, 1).expand(batchSize, self.label_size,
-                                                                                  self.label_size) + scores[:, wordIdx, :, :]
-            idxRecord[:, wordIdx, :] = torch.argmax(scoresIdx, 1)  ## the best previous label idx to crrent labels
-            scoresRecord[:, wordIdx, :] = torch.gather(scoresIdx, 1, idxRecord[:, wordIdx, :].view(batchSize, 1, self.label_size)).view(batchSize, self.label_size)
-
-        lastScores = torch.gather(scoresRecord, 1, word_seq_lens.view(batchSize, 1, 1).expand(batchSize, 1, self.label_size) - 1).view(batchSize, self.label_size)  ##select position
-        lastScores += self.transition[:, self.end_idx].view(1, self.label_size).expand(batchSize, self.label_size)
-        decodeIdx[:, 0] = torch.argmax(lastScores, 1)
-        bestScores = torch.gather(lastScores, 1, decodeIdx[:, 0].view(batchSize, 1))
+            ## batch x from_label x to_label x k
+            candidates = scores.unsqueeze(2) + transition.view(1, self.label_size, self.label_size, 1) + features[:, wordIdx, :].view(batchSize, 1, self.label_size, 1)
+            candidates = candidates.permute(0, 2, 1, 3).reshape(batchSize, self.label_size, self.label_size * k)
+            best, bestIdx = torch.topk(candidates, k, dim=2)
+            active = masks[:, wordIdx].view(batchSize, 1, 1)
+            scores = torch.where(active, best, scores)
+            prev_labels.append(torch.where(active, bestIdx // k, keep_labels))
+            prev_ranks.append(torch.where(active, bestIdx % k, keep_ranks))
+
+        lastScores = (scores + transition[:, self.end_idx].view(1, self.label_size, 1)).view(batchSize, self.label_size * k)
+        bestScores, bestIdx = torch.topk(lastScores, k, dim=1)
+        labels = bestIdx // k
+        ranks = bestIdx % k
+        decodeIdx = torch.zeros((batchSize, k, sentLength), dtype=torch.long, device=device)
+        decodeIdx[:, :, sentLength - 1] = labels
+        for wordIdx in range(sentLength - 1, 0, -1):
+            flat = labels * k + ranks
+            labels, ranks = torch.gather(prev_labels[wordIdx - 1].reshape(batchSize, -1), 1, flat), torch.gather(prev_ranks[wordIdx - 1].reshape(batchSize, -1), 1, flat)
+            decodeIdx[:, :, wordIdx - 1] = labels
+        decodeIdx = decodeIdx * masks.view(batchSize, 1, sentLength)
+        return bestScores, decodeIdx.cpu()
+
+    def marginals(self, features, word_seq_lens):
+        """
+        Forward-backward over the emissions and the transitions, batched like `forward_unlabeled`.
+        :param features: emission scores (batch, seq_len, label_size)
+        :param word_seq_lens: (batch)
+        :return: the posterior probability of every label at every position (batch, seq_len, label_size), 0 for the padded positions.
+        """
+        batchSize = features.shape[0]
+        sentLength = features.shape[1]
+        transition = self.get_transition()
+        maskTemp = torch.arange(sentLength, device=features.device).view(1, sentLength)
+        masks = maskTemp < word_seq_lens.to(features.device).view(batchSize, 1)
 
-        for distance2Last in range(sentLength - 1):
-            lastNIdxRecord = torch.gather(idxRecord, 1, torch.where(word_seq_lens - distance2Last - 1 > 0, word_seq_lens - distance2Last - 1, mask).view(batchSize, 1, 1).expand(batchSize, 1, self.label_size)).view(batchSize, self.label_size)
-            decodeIdx[:, distance2Last + 1] = torch.gather(lastNIdxRecord, 1, decodeIdx[:, distance2Last].view(batchSize, 1)).view(batchSize)
+        alphas = [transition[self.start_idx, :].view(1, self.label_size) + features[:, 0, :]]
+        for wordIdx in range(1, sentLength):
+            alphas.append(torch.logsumexp(alphas[-1].unsqueeze(2) + transition.unsqueeze(0), dim=1) + features[:, wordIdx, :])
+        alphas = torch.stack(alphas, 1)
+
+        end_scores = transition[:, self.end_idx].view(1, self.label_size).expand(batchSize, self.label_size)
+        betas = [end_scores]
+        for wordIdx in range(sentLength - 2, -1, -1):
+            ## the beta of the last word of a sentence only has the transition to STOP
+            next_beta = torch.logsumexp(transition.unsqueeze(0) + (features[:, wordIdx + 1, :] + betas[-1]).unsqueeze(1), dim=2)
+            betas.append(torch.where(masks[:, wordIdx + 1].unsqueeze(1), next_beta, end_scores))
+        betas = torch.stack(betas[::-1], 1)
+
+        last_alpha = torch.gather(alphas, 1, (word_seq_lens.to(features.device) - 1).view(batchSize, 1, 1).expand(batchSize, 1, self.label_size)).view(batchSize, self.label_size)
+        log_partition = torch.logsumexp(last_alpha + end_scores, dim=1)
+        posteriors = torch.exp(alphas + betas - log_partition.view(batchSize, 1, 1))
+        return posteriors * masks.unsqueeze(2).to(posteriors.dtype)
+
+    def decode_nbest(self, batchInput, k):
+        """
+        :return: the k best scores (batch, k) and label sequences (batch, k, seq_len)
+        """
+        wordSeqTensor, wordSeqLengths, batch_context_emb, charSeqTensor, charSeqLengths, adj_matrixs, adjs_in, adjs_out, graphs, dep_label_adj, batch_dep_heads, trees, tagSeqTensor, batch_dep_label = batchInput
+        features = self.neural_scoring(wordSeqTensor, wordSeqLengths, batch_context_emb,charSeqTensor,charSeqLengths, adj_matrixs, adjs_in, adjs_out, graphs, dep_label_adj, batch_dep_heads, batch_dep_label, trees)
+        return self.viterbiDecodeNBest(features, wordSeqLengths, k)
 
-        return bestScores, decodeIdx
+    def decode_with_marginals(self, batchInput):
+        """
+        Viterbi decoding together with the posterior marginals, sharing the emission scores.
+        :return: the best scores (batch, 1), the best label sequences (batch, seq_len) and the marginals (batch, seq_len, label_size)
+        """
+        wordSeqTensor, wordSeqLengths, batch_context_emb, charSeqTensor, charSeqLengths, adj_matrixs, adjs_in, adjs_out, graphs, dep_label_adj, batch_dep_heads, trees, tagSeqTensor, batch_dep_label = batchInput
+        features = self.neural_scoring(wordSeqTensor, wordSeqLengths, batch_context_emb,charSeqTensor,charSeqLengths, adj_matrixs, adjs_in, adjs_out, graphs, dep_label_adj, batch_dep_heads, batch_dep_label, trees)
+        bestScores, decodeIdx = self.viterbiDecode(features, wordSeqLengths)
+        return bestScores, decodeIdx, self.marginals(features, wordSeqLengths)
 
     def decode(self, batchInput):
         wordSeqTensor, wordSeqLengths, batch_context_emb, charSeqTensor, charSeqLengths, adj_matrixs, adjs_in, adjs_out, graphs, dep_label_adj, batch_dep_heads, trees, tagSeqTensor, batch_dep_label = batchInput
         features = self.neural_scoring(wordSeqTensor, wordSeqLengths, batch_context_emb,charSeqTensor,charSeqLengths, adj_matrixs, adjs_in, adjs_out, graphs, dep_label_adj, batch_dep_heads, batch_dep_label, trees)
-        all_scores = self.calculate_all_scores(features)
-        bestScores, decodeIdx = self.viterbiDecode(all_scores, wordSeqLengths)
+        bestScores, decodeIdx = self.viterbiDecode(features, wordSeqLengths)
         return bestScores, decodeIdx
@@ -0,0 +1,55 @@
+#
+# @author: Allan
+#
+
+import io
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from model.lstmcrf import NNCRF
+
+"""
+Reduced precision for CPU inference: dynamic int8 quantization of the LSTMs and the linear layers
+(the weights are stored in int8 and the activations are quantized on the fly), and the word embedding
+table stored in float16 or bfloat16. The CRF transition scores stay in float32.
+"""
+
+EMBEDDING_DTYPES = {"float32": torch.float32, "float16": torch.float16, "bfloat16": torch.bfloat16}
+
+
+class LowPrecisionEmbedding(nn.Module):
+    """
+    Frozen embedding table stored in float16/bfloat16, the looked up vectors are float32.
+    """
+
+    def __init__(self, embedding: nn.Embedding, dtype: torch.dtype):
+        super(LowPrecisionEmbedding, self).__init__()
+        self.register_buffer("weight", embedding.weight.detach().to(dtype))
+
+    def forward(self, input):
+        return F.embedding(input, self.weight).float()
+
+
+def quantize_model(model: NNCRF, quantize: str = "none", embedding_dtype: str = "float32") -> NNCRF:
+    """
+    Convert a trained model (in place) for inference, it can not be trained anymore.
+    :param quantize: "int8" for the dynamic quantization of `nn.LSTM` and `nn.Linear`, or "none"
+    :param embedding_dtype: float32, float16 or bfloat16 for the word embedding table
+    """
+    model.eval()
+    if quantize == "int8":
+        if model.device.type != "cpu":
+            raise ValueError("the int8 quantization is only supported on cpu, not on {}".format(model.device))
+        torch.ao.quantization.quantize_dynamic(model, {nn.LSTM, nn.Linear}, dtype=torch.qint8, inplace=True)
+    if embedding_dtype != "float32":
+        model.word_embedding = LowPrecisionEmbedding(model.word_embedding, EMBEDDING_DTYPES[embedding_dtype])
+    return model
+
+
+def model_size(model: nn.Module) -> int:
+    """
+    :return: the size of the serialized state dict in bytes (the int8 weights are packed)
+    """
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
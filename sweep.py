@@ -0,0 +1,180 @@
+#
+# @author: Allan
+#
+
+"""
+Hyperparameter sweep: every dataset is read and preprocessed once (vocabulary, ids, embedding table,
+contextual vectors), then the configurations are trained concurrently in forked processes which share
+the preprocessed data with the parent (copy-on-write). The best dev/test F1 of all the runs are collected
+into one table.
+
+Options that are not sweep options are passed to main.py, e.g.
+    python sweep.py --datasets catalan spanish --embedding_files data/cc.ca.300.vec data/cc.es.300.vec \
+        --dep_models none dglstm --num_lstm_layers 1 2 --num_workers 4 -- --context_emb elmo --num_epochs 300
+"""
+
+import os
+import sys
+import time
+import argparse
+import itertools
+import multiprocessing
+import queue
+from config.config import Config
+from config.reader import Reader
+from config.cpu import apply_cpu_profile, available_cores, split_cores
+import main
+
+
+def parse_sweep_arguments():
+    parser = argparse.ArgumentParser(description="Hyperparameter sweep of the Dependency-Guided LSTM CRF")
+    parser.add_argument('--datasets', type=str, nargs='+', required=True)
+    parser.add_argument('--embedding_files', type=str, nargs='+', required=True, help="one per dataset")
+    parser.add_argument('--num_epochs', type=int, nargs='+', default=[100], help="one per dataset, or one for all")
+    parser.add_argument('--dep_models', type=str, nargs='+', default=["none", "dglstm", "dggcn"], choices=["none", "dggcn", "dglstm"])
+    parser.add_argument('--inter_funcs', type=str, nargs='+', default=["mlp"], choices=["concatenation", "addition",  "mlp"], help="only for dglstm")
+    parser.add_argument('--num_lstm_layers', type=int, nargs='+', default=[1])
+    parser.add_argument('--num_gcn_layers', type=int, nargs='+', default=[1], help="only for dggcn")
+    parser.add_argument('--gcn_mlp_layers', type=int, nargs='+', default=[1], help="only for dggcn")
+    parser.add_argument('--gcn_dropouts', type=float, nargs='+', default=[0.5], help="only for dggcn")
+    parser.add_argument('--gcn_gates', type=int, nargs='+', default=[0], help="only for dggcn")
+    parser.add_argument('--num_workers', type=int, default=1, help="number of configurations trained at the same time")
+    parser.add_argument('--devices', type=str, nargs='+', default=None, help="devices of the workers (round robin), default: --device of main.py")
+    parser.add_argument('--log_dir', type=str, default="logs")
+    parser.add_argument('--results', type=str, default="results/sweep.tsv", help="table of the results")
+    args, main_argv = parser.parse_known_args()
+    if main_argv and main_argv[0] == "--":
+        main_argv = main_argv[1:]
+    if len(args.embedding_files) != len(args.datasets):
+        parser.error("--embedding_files needs one file per dataset")
+    if len(args.num_epochs) not in [1, len(args.datasets)]:
+        parser.error("--num_epochs needs one value, or one per dataset")
+    return args, main_argv
+
+
+def get_configurations(args):
+    """
+    The combinations of the sweep options. The options that a dependency model does not use keep
+    their first value, so that the same model is not trained twice.
+    """
+    configurations = []
+    for dep_model, inter_func, num_lstm_layer, num_gcn_layers, gcn_mlp_layers, gcn_dropout, gcn_gate in itertools.product(
+            args.dep_models, args.inter_funcs, args.num_lstm_layers, args.num_gcn_layers, args.gcn_mlp_layers, args.gcn_dropouts, args.gcn_gates):
+        if dep_model != "dglstm":
+            inter_func = args.inter_funcs[0]
+        if dep_model != "dggcn":
+            num_gcn_layers, gcn_mlp_layers, gcn_dropout, gcn_gate = args.num_gcn_layers[0], args.gcn_mlp_layers[0], args.gcn_dropouts[0], args.gcn_gates[0]
+        configuration = {"dep_model": dep_model, "inter_func": inter_func, "num_lstm_layer": num_lstm_layer, "num_gcn_layers": num_gcn_layers,
+                         "gcn_mlp_layers": gcn_mlp_layers, "gcn_dropout": gcn_dropout, "gcn_gate": gcn_gate}
+        if configuration not in configurations:
+            configurations.append(configuration)
+    return configurations
+
+
+def derive_config(data_config: Config, opt: argparse.Namespace, configuration) -> Config:
+    """
+    The config of one run: the options of the configuration, and the index tables and embedding table
+    already built for the dataset.
+    """
+    config = Config(argparse.Namespace(**dict(vars(opt), **configuration)))
+    config.set_vocab(data_config.get_vocab())
+    config.word_embedding = data_config.word_embedding
+    config.embedding_dim = data_config.embedding_dim
+    config.context_emb_size = data_config.context_emb_size
+    return config
+
+
+def run_configuration(opt: argparse.Namespace, config: Config, cores, data, log_file: str, results, job_id: int):
+    ## the output of the run goes to its own log file
+    log = os.open(log_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.dup2(log, 1)
+    os.dup2(log, 2)
+    apply_cpu_profile(config.num_threads, 0, cores)
+    main.setSeed(opt, config.seed)
+    trains, devs, tests = data
+    start_time = time.time()
+    best_dev, best_test = main.learn_from_insts(config, config.num_epochs, trains, devs, tests)
+    results.put((job_id, (best_dev, best_test, time.time() - start_time)))
+
+
+def sweep():
+    args, main_argv = parse_sweep_arguments()
+    configurations = get_configurations(args)
+    context = multiprocessing.get_context("fork")
+    results = context.Queue()
+    num_workers = max(1, args.num_workers)
+    slots = list(zip(split_cores(available_cores(), num_workers), [args.devices[i % len(args.devices)] if args.devices else None for i in range(num_workers)]))
+    if not os.path.exists(args.log_dir):
+        os.makedirs(args.log_dir)
+    datasets = []
+    for d, dataset in enumerate(args.datasets):
+        num_epochs = args.num_epochs[d] if len(args.num_epochs) > 1 else args.num_epochs[0]
+        opt = main.parse_arguments(argparse.ArgumentParser(), main_argv + ["--dataset", dataset, "--embedding_file", args.embedding_files[d], "--num_epochs", str(num_epochs)])
+        data_config = Config(opt)
+        main.setSeed(opt, data_config.seed)
+        data = main.prepare_data(data_config, Reader(data_config.digit2zero))
+        datasets.append((dataset, opt, data_config, data))
+    ## the jobs of all the datasets share the workers
+    pending = [(dataset, opt, data_config, data, configuration) for dataset, opt, data_config, data in datasets for configuration in configurations]
+    print("[Sweep] %d runs on %d workers" % (len(pending), num_workers), flush=True)
+
+    table = [None] * len(pending)
+    pending = list(enumerate(pending))
+    running = {}
+    free_slots = list(range(num_workers))
+    while pending or running:
+        while pending and free_slots:
+            job_id, (dataset, opt, data_config, data, configuration) = pending.pop(0)
+            slot = free_slots.pop(0)
+            cores, device = slots[slot]
+            job_opt = argparse.Namespace(**dict(vars(opt), device=device if device else opt.device))
+            config = derive_config(data_config, job_opt, configuration)
+            log_file = os.path.join(args.log_dir, "sweep_{}_{}.log".format(dataset, "_".join("{}_{}".format(key, value) for key, value in configuration.items())))
+            process = context.Process(target=run_configuration, args=(job_opt, config, cores, data, log_file, results, job_id))
+            process.start()
+            running[job_id] = (process, slot, dataset, configuration, log_file)
+            print("[Sweep] started %s %s -> %s" % (dataset, configuration, log_file), flush=True)
+        try:
+            job_id, result = results.get(timeout=1)
+        except queue.Empty:
+            ## a process that ended without a result has failed (the result is sent before a normal exit)
+            for job_id in [job_id for job_id, (process, _, _, _, _) in running.items() if not process.is_alive() and process.exitcode != 0]:
+                process, slot, dataset, configuration, log_file = running.pop(job_id)
+                process.join()
+                free_slots.append(slot)
+                print("[Sweep] failed %s %s, see %s" % (dataset, configuration, log_file), flush=True)
+                table[job_id] = [dataset, configuration, None, None, None, None, log_file]
+            continue
+        process, slot, dataset, configuration, log_file = running.pop(job_id)
+        process.join()
+        free_slots.append(slot)
+        best_dev, best_test, elapsed = result
+        print("[Sweep] done %s %s: dev %.2f, test %.2f (epoch %d), %.0fs" % (dataset, configuration, best_dev[0], best_test[0], best_dev[1], elapsed), flush=True)
+        table[job_id] = [dataset, configuration, best_dev[0], best_test[0], best_dev[1], elapsed, log_file]
+    write_table(table, args.results)
+
+
+def write_table(table, file: str):
+    keys = ["dep_model", "inter_func", "num_lstm_layer", "num_gcn_layers", "gcn_mlp_layers", "gcn_dropout", "gcn_gate"]
+    header = ["dataset"] + keys + ["dev_f1", "test_f1", "best_epoch", "time", "log"]
+    lines = ["\t".join(header)]
+    for dataset, configuration, dev_f1, test_f1, epoch, elapsed, log_file in table:
+        values = [dataset] + [str(configuration[key]) for key in keys]
+        if dev_f1 is None:
+            values += ["failed", "", "", "", log_file]
+        else:
+            values += ["%.2f" % dev_f1, "%.2f" % test_f1, str(epoch), "%.0f" % elapsed, log_file]
+        lines.append("\t".join(values))
+    directory = os.path.dirname(file)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    with open(file, 'w', encoding='utf-8') as f:
+        f.write("\n".join(lines) + "\n")
+    print("\n".join(lines))
+    print("[Sweep] results written to: %s" % (file))
+
+
+if __name__ == "__main__":
+    sweep()